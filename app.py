@@ -1,23 +1,64 @@
 import asyncio
+import signal
+import sys
 import threading
-from flask import Flask
+import time
+from flask import Flask, Response
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_sdk import WebClient
 from loguru import logger
-from assistants import process_thread_with_assistant
+from conversation_queue import ConversationQueue
+from fan_out import fan_out, summarize_fan_out
+from file_utils import file_cache
+from logging_config import configure_logging, flush_logging, sampled_run, summarize
+from metrics import labelled, render_metrics, stage, track_worker_pool
+from response_cache import create_response_cache, process_with_cache
+from tools import tool_registry
+from slack_output import ProgressiveMessage, SlackPoster, attribute_messages, slack_messages, upload_files
+from replicas import create_dedup_store, create_replica_router
+from session_store import create_session_store
+from worker_pool import WorkerPool, QueueFullError
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Configure Loguru
-logger.add("app.log", rotation="500 MB", retention="10 days", level="DEBUG")
-logger.debug("Loguru configured with file rotation and retention")
+# Configure Loguru; LOG_MODE=production enables enqueued sinks and DEBUG sampling
+configure_logging()
 
 # Initialize Slack app with Socket Mode
-slack_app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
+if os.environ.get("SLACK_API_URL"):
+    # Point the Web API client at another endpoint, such as the local stand-in used by the load test
+    slack_app = App(client=WebClient(token=os.environ.get("SLACK_BOT_TOKEN"), base_url=os.environ["SLACK_API_URL"]))
+else:
+    slack_app = App(token=os.environ.get("SLACK_BOT_TOKEN"))
 logger.debug("Slack app initialized with token")
 
+# Long-lived async runtime shared by all message handlers
+worker_pool = WorkerPool(
+    concurrency=int(os.environ.get("WORKER_CONCURRENCY", "8")),
+    queue_limit=int(os.environ.get("WORKER_QUEUE_LIMIT", "100")),
+    drain_timeout=float(os.environ.get("WORKER_DRAIN_TIMEOUT", "30")),
+)
+track_worker_pool(worker_pool)
+logger.debug("Worker pool configured")
+
+# Answers are posted from the worker pool's loop with the async Slack client, paced per channel
+slack_poster = SlackPoster(
+    os.environ.get("SLACK_BOT_TOKEN"),
+    base_url=os.environ.get("SLACK_API_URL"),
+    channel_interval=float(os.environ.get("SLACK_CHANNEL_INTERVAL", "1.0")),
+)
+worker_pool.add_cleanup(slack_poster.close)
+worker_pool.add_cleanup(tool_registry.close)
+
+# Stream answers into a placeholder message that is edited in place
+STREAMING_RESPONSES = os.environ.get("STREAMING_RESPONSES", "true").lower() == "true"
+SLACK_UPDATE_INTERVAL = float(os.environ.get("SLACK_UPDATE_INTERVAL", "1.0"))
+# "mrkdwn" posts formatted text; "blocks" renders headings, lists and code as Block Kit
+SLACK_OUTPUT_MODE = os.environ.get("SLACK_OUTPUT_MODE", "mrkdwn")
+
 socket_mode_handler = SocketModeHandler(slack_app, os.environ["SLACK_APP_TOKEN"])
 logger.debug("SocketModeHandler initialized with app token")
 
@@ -67,80 +108,244 @@ DRUMBEAT_ASSISTANT_DATA = {
         "vectorstore_id": "vs_1d1MAdCRPQMM93uNqspijKJB"
     }
 }
+# Metrics are labelled with the drumbeat name of the assistant that served a run
+DRUMBEAT_NAMES = {data["assistant_id"]: name for name, data in DRUMBEAT_ASSISTANT_DATA.items()}
+# Cached answers are invalidated when the files of the assistant's vectorstore change
+VECTOR_STORE_IDS = {data["assistant_id"]: data["vectorstore_id"] for data in DRUMBEAT_ASSISTANT_DATA.values()}
 logger.debug("Assistant IDs and vectorstores defined")
 
-# User Sessions: Dictionary to store user-specific thread IDs and selected assistant
-user_sessions = {}
-logger.debug("User session dictionary initialized")
+# Fan-out mode asks every drumbeat at once, either when "All drumbeats" is
+# selected on the home tab or for messages starting with FAN_OUT_PREFIX
+ALL_DRUMBEATS = "All drumbeats"
+FAN_OUT_PREFIX = os.environ.get("FAN_OUT_PREFIX", "all:")
+FAN_OUT_CONCURRENCY = int(os.environ.get("FAN_OUT_CONCURRENCY", "5"))
+FAN_OUT_DEADLINE = float(os.environ.get("FAN_OUT_DEADLINE", "120"))
+
+# Sending exactly this text starts a fresh thread; THREAD_MAX_MESSAGES and
+# THREAD_IDLE_TIMEOUT rotate threads automatically (see thread_policy.py)
+RESET_COMMAND = os.environ.get("RESET_COMMAND", "reset")
+
+# Opt-in (RESPONSE_CACHE=true): repeated new-thread questions to the same
+# assistant are answered from memory until the TTL expires or its files change
+response_cache = create_response_cache()
+logger.debug(f"Response cache {'enabled' if response_cache is not None else 'disabled'}")
+
+# User Sessions: Store of user-specific thread IDs and selected assistant
+user_sessions = create_session_store(defaults={
+    "thread_id": None, "assistant_id": os.environ.get('ASSISTANT_ID'), "fan_out": False, "message_count": 0, "last_active": None
+})
+logger.debug(f"User session store initialized: {type(user_sessions).__name__}")
+
+# Several replicas can run side by side (REPLICA_COUNT, REPLICA_INDEX): each
+# Slack event is handled once thanks to the shared dedup store, and all of a
+# user's messages are routed to the same replica
+dedup_store = create_dedup_store()
+replica_router = create_replica_router()
+logger.debug(f"Replica {replica_router.replica_index} of {replica_router.replica_count}, dedup store: {type(dedup_store).__name__}")
 
 def is_authorized_user(user_id):
-    logger.debug(f"Checking if user ID {user_id} is authorized")
+    logger.debug("Checking if user ID {} is authorized", user_id)
     return user_id in AUTHORIZED_USER_IDS
 
 @slack_app.message("")
-def message_handler(message, say, ack):
+def message_handler(message, say, ack, body=None):
     ack()
     user_id = message.get('user')
 
+    # Slack redelivers unacknowledged events, possibly to another replica
+    event_id = (body or {}).get("event_id") or f"{message['channel']}:{message['ts']}"
+    if not dedup_store.claim(event_id):
+        logger.debug("Ignoring duplicate delivery of event {}", event_id)
+        return
+
     if not is_authorized_user(user_id):
         logger.warning(f"Unauthorized message from user ID: {user_id}")
         say(f"Sorry <@{user_id}>, you are not authorized to use this bot.")
         return  # Simply return without processing the message
 
-    logger.debug(f"Received message from authorized user: {user_id}")
-    user_query = message['text']
+    logger.debug("Received message from authorized user: {}", user_id)
     thread_ts = message['ts']
-    channel = message['channel']
+    item = {"text": message['text'], "ts": thread_ts, "channel": message['channel']}
+    # A reset is queued like any message, so it takes effect after the user's earlier messages are answered
+    if message['text'].strip().lower() == RESET_COMMAND.strip().lower():
+        item["reset"] = True
 
-    # Get or create a thread ID for the user
-    if user_id not in user_sessions:
-        user_sessions[user_id] = {"thread_id": None, "assistant_id": os.environ.get('ASSISTANT_ID')}
-    thread_id = user_sessions[user_id]["thread_id"]
+    if replica_router.replicated:
+        replica_router.forward(user_id, item)
+        return
+    notice = enqueue_message(user_id, item)
+    if notice:
+        say(notice, thread_ts=thread_ts)
 
-    def process_and_respond():
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        logger.debug("Event loop set for async processing.")
-
-        async def async_process_and_respond():
-            assistant_id = user_sessions[user_id]["assistant_id"]
-            response = await process_thread_with_assistant(
-                user_query, assistant_id, from_user=user_id, thread_id=thread_id
+def enqueue_message(user_id, item):
+    """Submits a message to the conversation queue and returns the notice to reply with, if any."""
+    try:
+        position = conversation_queue.submit(user_id, item)
+    except QueueFullError as e:
+        logger.warning(f"Rejecting message from user ID {user_id}: {e}")
+        return "Sorry, I'm handling too many requests right now. Please try again in a few minutes."
+    logger.debug("User query submitted to the conversation queue at position {}.", position)
+    if position is None and item.get("reset"):
+        return "I'll start a fresh conversation as soon as I've answered your previous message."
+    if position is None:
+        return "I'm still working on your previous message; I'll answer this one together with anything else you send meanwhile."
+    if position:
+        return f"I'm busy with other requests right now; your message is queued at position {position}."
+    return None
+
+async def handle_routed_message(user_id, item):
+    """Enqueues a message another replica (or this one) routed to this replica."""
+    notice = enqueue_message(user_id, item)
+    if notice:
+        await slack_poster.post_message(item["channel"], item["ts"], text=notice)
+
+async def handle_expired_message(user_id, item):
+    """Tells the user a message routed to an unavailable replica was dropped."""
+    await slack_poster.post_message(
+        item["channel"], item["ts"],
+        text="Sorry, I couldn't get to this message in time. Please send it again."
+    )
+
+async def process_and_respond(user_id, batch):
+    """Answers a batch of messages from one user, applying resets in order.
+
+    A reset in the batch splits it: the messages before it are answered in
+    the current thread, then the thread is dropped, and the messages after
+    it start a new one.
+    """
+    messages = []
+    for item in batch:
+        if not item.get("reset"):
+            messages.append(item)
+            continue
+        if messages:
+            await answer_messages(user_id, messages)
+            messages = []
+        await asyncio.to_thread(user_sessions.update, user_id, thread_id=None, message_count=0, last_active=None)
+        logger.info(f"Thread reset by user ID: {user_id}")
+        await slack_poster.post_message(
+            item["channel"], item["ts"], text="Started a fresh conversation; your next message opens a new thread."
+        )
+    if messages:
+        await answer_messages(user_id, messages)
+
+async def answer_messages(user_id, batch):
+    """Answers a batch of messages from one user with a single assistant run.
+
+    Messages that arrived while an earlier run for the user was still queued
+    or in progress are coalesced into one query, answered in the thread of
+    the most recent message.
+    """
+    # Read the session only now, so a thread created by the previous batch is reused
+    # The store may wait on a SQLite lock, so it is read off the event loop
+    session = await asyncio.to_thread(user_sessions.get, user_id)
+    texts = [item["text"] for item in batch]
+    fan_out_prefix = FAN_OUT_PREFIX.strip().lower()
+    fan_out_requested = session["fan_out"] or any(text.lower().startswith(fan_out_prefix) for text in texts)
+    drumbeat = ALL_DRUMBEATS if fan_out_requested else DRUMBEAT_NAMES.get(session["assistant_id"], "default")
+    # DEBUG records of this run are only written if it is sampled (see LOG_SAMPLE_RATE)
+    with sampled_run(), labelled(drumbeat), stage("total"):
+        if fan_out_requested:
+            query = "\n\n".join(
+                text[len(fan_out_prefix):].strip() if text.lower().startswith(fan_out_prefix) else text for text in texts
             )
-            logger.debug(f"Response from assistant: {response}")
-
-            if response:
-                user_sessions[user_id]["thread_id"] = response.get("thread_id")
-                for text in response.get("text", []):
-                    slack_app.client.chat_postMessage(
-                        channel=channel,
-                        text=text,
-                        mrkdwn=True,
-                        thread_ts=thread_ts
-                    )
-            else:
-                say("Sorry, I couldn't process your request.", thread_ts=thread_ts)
-            logger.info("Response processed and sent to user.")
-
-        loop.run_until_complete(async_process_and_respond())
-
-    threading.Thread(target=process_and_respond).start()
-    logger.debug("Processing user query in a separate thread.")
+            await answer_fan_out(user_id, query, batch[-1]["channel"], batch[-1]["ts"])
+        else:
+            await answer_batch(user_id, batch, session)
+
+async def answer_fan_out(user_id, query, channel, thread_ts):
+    """Asks every drumbeat at once and posts each answer, labelled with its drumbeat, as it arrives."""
+    assistants = {name: data["assistant_id"] for name, data in DRUMBEAT_ASSISTANT_DATA.items()}
+    status_message = ProgressiveMessage(
+        slack_poster, channel, thread_ts,
+        placeholder=f"_Asking {len(assistants)} drumbeats…_", min_interval=SLACK_UPDATE_INTERVAL
+    )
+    await status_message.start()
+    answered = 0
+
+    async def post_answer(name, response):
+        nonlocal answered
+        await slack_poster.post_messages(channel, thread_ts, attribute_messages(slack_messages(response, SLACK_OUTPUT_MODE), name))
+        await upload_files(slack_poster, response.get("files", []), channel, thread_ts)
+        answered += 1
+        await status_message.update(f"_Asking {len(assistants)} drumbeats… {answered} answered so far_")
+
+    statuses = await fan_out(
+        query, assistants, post_answer, from_user=user_id,
+        max_concurrency=FAN_OUT_CONCURRENCY, deadline=FAN_OUT_DEADLINE,
+        response_cache=response_cache, vector_store_ids=VECTOR_STORE_IDS
+    )
+    await status_message.finish([{"text": summarize_fan_out(statuses, FAN_OUT_DEADLINE)}])
+    logger.info(f"Fan-out response sent to user: {answered} of {len(assistants)} drumbeats answered.")
+
+async def answer_batch(user_id, batch, session):
+    """Runs the coalesced query through the user's assistant and posts the answer."""
+    user_query = "\n\n".join(item["text"] for item in batch)
+    thread_ts = batch[-1]["ts"]
+    channel = batch[-1]["channel"]
+    thread_id = session["thread_id"]
+    assistant_id = session["assistant_id"]
+
+    if STREAMING_RESPONSES:
+        progressive_message = ProgressiveMessage(
+            slack_poster, channel, thread_ts, min_interval=SLACK_UPDATE_INTERVAL
+        )
+        await progressive_message.start()
+        response = await process_with_cache(
+            response_cache, user_query, assistant_id, VECTOR_STORE_IDS.get(assistant_id),
+            from_user=user_id, thread_id=thread_id, stream=True, on_text=progressive_message.update,
+            message_count=session["message_count"], last_active=session["last_active"]
+        )
+        logger.opt(lazy=True).debug("Response from assistant: {}", lambda: summarize(response))
+        await save_thread(user_id, response)
+        await progressive_message.finish(slack_messages(response, SLACK_OUTPUT_MODE), has_files=bool(response.get("files")))
+        await upload_files(slack_poster, response.get("files", []), channel, thread_ts)
+        logger.info("Streamed response processed and sent to user.")
+        return
+
+    response = await process_with_cache(
+        response_cache, user_query, assistant_id, VECTOR_STORE_IDS.get(assistant_id),
+        from_user=user_id, thread_id=thread_id,
+        message_count=session["message_count"], last_active=session["last_active"]
+    )
+    logger.opt(lazy=True).debug("Response from assistant: {}", lambda: summarize(response))
+    await save_thread(user_id, response)
+
+    slack_message_list = slack_messages(response, SLACK_OUTPUT_MODE)
+    if not slack_message_list and not response.get("files"):
+        slack_message_list = [{"text": "Sorry, I couldn't process your request."}]
+    await slack_poster.post_messages(channel, thread_ts, slack_message_list)
+    await upload_files(slack_poster, response.get("files", []), channel, thread_ts)
+    logger.info("Response processed and sent to user.")
+
+async def save_thread(user_id, response):
+    """Records the thread an answer came from, which may have been rotated, for the user's next message."""
+    await asyncio.to_thread(
+        user_sessions.update,
+        user_id,
+        thread_id=response.get("thread_id"),
+        message_count=response.get("message_count", 0),
+        last_active=time.time()
+    )
+
+conversation_queue = ConversationQueue(worker_pool, process_and_respond)
+logger.debug("Conversation queue initialized")
 
 @slack_app.action("select_drumbeat")
 def handle_drumbeat_selection(ack, body, logger):
+    # Acknowledge first: the session store may wait on a SQLite lock for longer than Slack's 3 seconds
+    ack()
     user_id = body['user']['id']
     selected_drumbeat = body['actions'][0]['selected_option']['value']
     assistant_data = DRUMBEAT_ASSISTANT_DATA.get(selected_drumbeat)
-    if assistant_data:
-        user_sessions[user_id]["assistant_id"] = assistant_data["assistant_id"]
+    if selected_drumbeat == ALL_DRUMBEATS:
+        user_sessions.update(user_id, fan_out=True)
+        logger.info(f"User {user_id} selected fan-out across all drumbeats")
+    elif assistant_data:
+        user_sessions.update(user_id, assistant_id=assistant_data["assistant_id"], fan_out=False)
         logger.info(f"User {user_id} selected drumbeat: {selected_drumbeat}, Assistant ID: {assistant_data['assistant_id']}")
     else:
         logger.error(f"Invalid drumbeat selection: {selected_drumbeat}")
-    ack()
 
 @slack_app.event("app_home_opened")
 def app_home_opened(client, event, logger):
@@ -181,7 +386,7 @@ def app_home_opened(client, event, logger):
                                             "emoji": True
                                         },
                                         "value": drumbeat_name
-                                    } for drumbeat_name in DRUMBEAT_ASSISTANT_DATA
+                                    } for drumbeat_name in [ALL_DRUMBEATS, *DRUMBEAT_ASSISTANT_DATA]
                                 ],
                                 "action_id": "select_drumbeat"
                             }
@@ -191,7 +396,7 @@ def app_home_opened(client, event, logger):
                             "type": "section",
                             "text": {
                                 "type": "mrkdwn",
-                                "text": "Here are some example prompts to get you started:\n• What is the latest information on [topic]?\n• Can you provide a summary of [document/topic]?\n• What are the key takeaways from [meeting/event]?"
+                                "text": f"Here are some example prompts to get you started:\n• What is the latest information on [topic]?\n• Can you provide a summary of [document/topic]?\n• What are the key takeaways from [meeting/event]?\n\nStart a message with `{FAN_OUT_PREFIX}` to ask every drumbeat at once. Send `{RESET_COMMAND}` to start a fresh conversation."
                             }
                         }
                     ]
@@ -217,6 +422,45 @@ def app_home_opened(client, event, logger):
         )
 
 
+# Prometheus metrics endpoint
+flask_app = Flask(__name__)
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+
+@flask_app.route("/metrics")
+def metrics_endpoint():
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
+def handle_sigterm(signum, frame):
+    logger.info("Received SIGTERM, shutting down")
+    sys.exit(0)
+
+
 # Start the Flask app
 if __name__ == "__main__":
-    socket_mode_handler.start()
\ No newline at end of file
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    worker_pool.start()
+    worker_pool.spawn(file_cache.run_background_refresh())
+    if replica_router.replicated:
+        # The consumer stops claiming at shutdown but submits what it already claimed before the pool drains
+        worker_pool.spawn(
+            replica_router.consume(handle_routed_message, handle_expired_message, stopping=lambda: worker_pool.stopping),
+            graceful=True
+        )
+    threading.Thread(
+        target=flask_app.run,
+        kwargs={"host": METRICS_HOST, "port": METRICS_PORT},
+        name="metrics-server",
+        daemon=True
+    ).start()
+    try:
+        socket_mode_handler.start()
+    finally:
+        socket_mode_handler.close()
+        worker_pool.shutdown()
+        user_sessions.close()
+        dedup_store.close()
+        replica_router.close()
+        flush_logging()
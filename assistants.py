@@ -1,198 +1,325 @@
 import asyncio
 import json
 import os
-from openai import AsyncOpenAI
+import time
 from loguru import logger
-from file_utils import replace_file_ids_with_urls
-import re
+from file_utils import file_cache, file_store, collect_file_ids, generated_file_ids, guess_mime_type, render_annotated_text
+from logging_config import summarize
+from metrics import RunTimer, record_run, stage
+from openai_client import client, scheduler
+from thread_policy import thread_policy
+from tools import tool_registry
+from slack_format import split_for_slack
 
-api_key = os.environ.get("OPENAI_API_KEY")
-client = AsyncOpenAI(api_key=api_key)
-
-def format_for_slack(text):
-    """Formats text for Slack, replacing Markdown elements for better compatibility.
-
-    Args:
-        text (str): The input text with Markdown formatting.
-
-    Returns:
-        str: The formatted text with Slack-compatible formatting.
-    """
-    # Bold
-    text = re.sub(r'\*\*(.*?)\*\*', r'*\1*', text)
-    # Italics
-    text = re.sub(r'\*(.*?)\*', r'_\1_', text)
-    # Strikethrough (No Slack equivalent - removing)
-    text = re.sub(r'~~(.*?)~~', r'\1', text)
-    # Inline Code (No Slack equivalent - removing)
-    text = re.sub(r'`(.*?)`', r'\1', text)
-    # Blockquote 
-    text = re.sub(r'^> (.*)', r'\n>\1', text, flags=re.MULTILINE)
-    # Code Block (No Slack equivalent - removing backticks)
-    text = re.sub(r'```(.*?)```', r'\1', text, flags=re.DOTALL)
-    # Ordered List
-    text = re.sub(r'(\d+)\. ', r'\1. \n', text)  # Add newline after each list item
-    # Bulleted List
-    text = re.sub(r'^\* ', r'• ', text, flags=re.MULTILINE)  # Replace asterisk with bullet point
-    # Headings
-    text = re.sub(r'^# (.*?)\n', r'*\1*\n', text)  # H1 to bold
-    text = re.sub(r'^## (.*?)\n', r'_\1_\n', text)  # H2 to italic
-    text = re.sub(r'### (.*?)\n', r'*\1*\n', text)  # H3 to bold
-    text = re.sub(r'#### (.*?)\n', r'_\1_\n', text)  # H4 to italic
-
-    return text
+# Statuses after which a run never changes again (openai RunStatus)
+TERMINAL_RUN_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete")
+# A polled run still going after this many seconds is cancelled, so it cannot hold a worker forever
+RUN_TIMEOUT = float(os.environ.get("RUN_TIMEOUT", "600"))
 
 async def execute_function(function_name, arguments, from_user):
-    # Implement your function execution logic here
-    # For now, return a dummy response
-    return {"status": "error", "message": "Function not recognized"}
+    # Tools are registered with tool_registry.register in tools.py
+    return await tool_registry.execute(function_name, arguments, from_user)
 
 async def process_tool_call(tool_call, from_user):
     function_name = tool_call.function.name
-    arguments = json.loads(tool_call.function.arguments)
-    function_output = await execute_function(function_name, arguments, from_user)
-    function_output_str = json.dumps(function_output)
+    try:
+        arguments = json.loads(tool_call.function.arguments or "{}")
+    except ValueError as e:
+        logger.warning(f"Invalid arguments for tool {function_name}: {e}")
+        function_output = {"status": "error", "message": f"Invalid JSON arguments: {e}"}
+    else:
+        function_output = await execute_function(function_name, arguments, from_user)
+    function_output_str = json.dumps(function_output, default=str)
     return {
         "tool_call_id": tool_call.id,
         "output": function_output_str
     }
 
-async def process_thread_with_assistant(query, assistant_id, model="gpt-4o", from_user=None, thread_id=None):
+async def cancel_run(thread_id, run_id):
+    """Cancels a run on OpenAI so an abandoned run stops spending tokens; failures are only logged."""
+    try:
+        await scheduler.call("runs", client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run_id)
+        logger.debug("Cancelled run {} of thread ID: {}", run_id, thread_id)
+    except Exception as e:
+        logger.warning(f"Could not cancel run {run_id} of thread ID {thread_id}: {e}")
+
+async def collect_message_content(message, response_texts, response_files, response_markdown):
+    """Post-processes a completed assistant message into Slack-ready text parts.
+
+    Text parts get their file IDs, citations and file paths resolved; the
+    resolved Markdown is appended to `response_markdown` and its Slack
+    formatting, split to Slack's message size, to `response_texts`. Files
+    the message hands to the user, from `file_path` annotations and
+    `image_file` parts, are appended to `response_files` as
+    (file_id, mime_type) tuples.
+    """
+    text_contents = [content.text for content in message.content if content.type == "text"]
+    file_ids = generated_file_ids(message)
+    with stage("file_resolution"):
+        known_files = await file_cache.get_many(collect_file_ids(text_contents) + file_ids)
+    logger.debug("Resolved {} referenced files", len(known_files))
+
+    for file_id in file_ids:
+        if any(file_id == known_id for known_id, _ in response_files):
+            continue
+        mime_type = guess_mime_type(file_id, known_files)
+        logger.debug("File ID: {}, MIME type: {}", file_id, mime_type)
+        response_files.append((file_id, mime_type))
+
+    for content in message.content:
+        logger.debug("Processing {} content part", content.type)
+        if content.type == "text":
+            with stage("formatting"):
+                text_value = render_annotated_text(content.text.value, content.text.annotations, known_files)
+                slack_texts = split_for_slack(text_value)
+            logger.opt(lazy=True).debug("Text value after resolving annotations and file IDs: {}", lambda: summarize(text_value))
+
+            response_markdown.append(text_value)
+            logger.debug("Text value formatted into {} Slack messages", len(slack_texts))
+            response_texts.extend(slack_texts)
+
+async def download_response_files(response_files):
+    """Streams the files attached to an answer into the local file store.
+
+    Returns:
+        list: One dict per successfully downloaded file, as returned by `file_store.download`.
+    """
+    results = await asyncio.gather(
+        *(file_store.download(file_id, mime_type) for file_id, mime_type in response_files),
+        return_exceptions=True
+    )
+    downloaded_files = []
+    for (file_id, mime_type), result in zip(response_files, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to retrieve content for file ID: {file_id}. Error: {result}")
+        else:
+            downloaded_files.append(result)
+    return downloaded_files
+
+async def consume_run_stream(stream, on_delta, run_timer):
+    """Consumes an Assistants event stream, forwarding text deltas as they arrive.
+
+    Args:
+        stream (AsyncAssistantEventHandler): The entered run stream.
+        on_delta (callable): Coroutine function called with each text delta.
+        run_timer (RunTimer): Receives every run status change.
+
+    Returns:
+        tuple: The last run snapshot and the assistant messages completed during the stream.
+    """
+    completed_messages = []
+    async for event in stream:
+        if event.event == "thread.message.delta":
+            for part in event.data.delta.content or []:
+                if part.type == "text" and part.text and part.text.value:
+                    await on_delta(part.text.value)
+        elif event.event == "thread.message.completed":
+            if event.data.role == "assistant":
+                completed_messages.append(event.data)
+        elif event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step."):
+            logger.debug("Run {} status changed to: {}", event.data.id, event.data.status)
+            run_timer.transition(event.data.status)
+    return stream.current_run, completed_messages
+
+async def stream_run(thread_id, assistant_id, model, from_user, on_text=None):
+    """Executes a run through the streaming API, handling tool calls mid-stream.
+
+    If the caller gives up on the run, e.g. at a fan-out deadline, the run
+    is cancelled on OpenAI as well.
+
+    Returns:
+        tuple: The final run and the assistant messages it produced.
+    """
+    messages = []
+    streamed_text = ""
+    run_timer = RunTimer()
+    run = None
+    stream = None
+
+    async def on_delta(delta):
+        nonlocal streamed_text
+        streamed_text += delta
+        if on_text:
+            await on_text(streamed_text)
+
+    try:
+        async with scheduler.stream("runs", lambda: client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            model=model,
+            truncation_strategy=thread_policy.truncation_strategy()
+        )) as stream:
+            run, completed = await consume_run_stream(stream, on_delta, run_timer)
+            messages.extend(completed)
+
+        while run and run.status == "requires_action":
+            logger.debug("Run requires action. Executing specified functions in parallel...")
+            tool_calls = run.required_action.submit_tool_outputs.tool_calls
+            logger.opt(lazy=True).debug("Tool calls to process: {}", lambda: summarize(tool_calls))
+            tasks = [process_tool_call(tool_call, from_user) for tool_call in tool_calls]
+            with stage("tool_execution"):
+                tool_outputs = await asyncio.gather(*tasks)
+            logger.opt(lazy=True).debug("Tool outputs: {}", lambda: summarize(tool_outputs))
+
+            logger.debug("Submitting tool outputs for run ID: {}", run.id)
+            async with scheduler.stream("runs", lambda: client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=thread_id,
+                run_id=run.id,
+                tool_outputs=tool_outputs
+            )) as stream:
+                run, completed = await consume_run_stream(stream, on_delta, run_timer)
+                messages.extend(completed)
+    except asyncio.CancelledError:
+        current = (stream.current_run if stream is not None else None) or run
+        if current is not None and current.status not in TERMINAL_RUN_STATUSES:
+            await cancel_run(thread_id, current.id)
+        raise
+
+    return run, messages
+
+async def process_thread_with_assistant(query, assistant_id, model="gpt-4o", from_user=None, thread_id=None, stream=False, on_text=None, message_count=0, last_active=None):
+    """Sends a query to an assistant and collects its Slack-formatted answer.
+
+    With `stream=True` the run is executed through the Assistants streaming
+    API instead of polling, and `on_text` (a coroutine function) receives the
+    raw answer text accumulated so far as deltas arrive. The returned texts
+    are post-processed the same way in both modes.
+
+    `message_count` and `last_active` (a Unix timestamp) describe the
+    existing thread; when `thread_policy` decides it has grown too long or
+    sat idle too long, the query goes to a fresh thread seeded with a
+    summary instead. The returned `thread_id` and `message_count` are those
+    of the thread actually used. If the caller gives up on the query, e.g.
+    at a fan-out deadline, its run is cancelled on OpenAI as well.
+    """
     response_texts = []
+    response_markdown = []
     response_files = []
-    in_memory_files = []
+    downloaded_files = []
+    # The polled run that is still going, cancelled on OpenAI if the caller gives up on it
+    active_run_id = None
     try:
-        if not thread_id:
+        rotation_reason = thread_policy.rotation_reason(message_count, last_active) if thread_id else None
+        if rotation_reason:
+            logger.info(f"Rotating thread {thread_id} ({rotation_reason})")
+            thread_id, message_count = await thread_policy.rotate(thread_id)
+            logger.debug("Rotated to thread ID: {}", thread_id)
+        elif not thread_id:
             logger.debug("Creating a new thread for the user query...")
-            thread = await client.beta.threads.create()
+            with stage("thread_create"):
+                thread = await scheduler.call("threads", client.beta.threads.create)
             thread_id = thread.id
-            logger.debug(f"New thread created with ID: {thread_id}")
+            message_count = 0
+            logger.debug("New thread created with ID: {}", thread_id)
         
-        logger.debug(f"Adding the user query as a message to the thread with ID: {thread_id}, query: {query}")
-        await client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=query
-        )
+        logger.opt(lazy=True).debug("Adding the user query as a message to the thread with ID: {}, query: {}", lambda: thread_id, lambda: summarize(query))
+        with stage("message_create"):
+            await scheduler.call(
+                "messages",
+                client.beta.threads.messages.create,
+                thread_id=thread_id,
+                role="user",
+                content=query
+            )
+        message_count += 1
         logger.debug("User query added to the thread.")
 
-        logger.debug(f"Creating a run to process the thread with the assistant ID: {assistant_id}, model: {model}")
-        run = await client.beta.threads.runs.create(
+        if stream:
+            logger.debug("Streaming a run to process the thread with the assistant ID: {}, model: {}", assistant_id, model)
+            run, messages = await stream_run(thread_id, assistant_id, model, from_user, on_text=on_text)
+            logger.opt(lazy=True).debug("Streamed run finished with status: {}", lambda: run.status if run else None)
+            record_run(run.status if run else None)
+            message_count += len(messages)
+            for message in messages:
+                await collect_message_content(message, response_texts, response_files, response_markdown)
+            downloaded_files = await download_response_files(response_files)
+            logger.debug("Returning {} response texts and {} files, Thread ID: {}", len(response_texts), len(downloaded_files), thread_id)
+            return {"text": response_texts, "markdown": response_markdown, "files": downloaded_files, "thread_id": thread_id, "message_count": message_count}
+
+        logger.debug("Creating a run to process the thread with the assistant ID: {}, model: {}", assistant_id, model)
+        run = await scheduler.call(
+            "runs",
+            client.beta.threads.runs.create,
             thread_id=thread_id,
             assistant_id=assistant_id,
-            model=model
+            model=model,
+            truncation_strategy=thread_policy.truncation_strategy()
         )
-        logger.debug(f"Run created with ID: {run.id}")
+        logger.debug("Run created with ID: {}", run.id)
+        active_run_id = run.id
+        run_timer = RunTimer(run.status)
+        deadline = time.monotonic() + RUN_TIMEOUT
 
         while True:
-            logger.debug(f"Checking the status of the run with ID: {run.id}")
-            run_status = await client.beta.threads.runs.retrieve(
+            logger.debug("Checking the status of the run with ID: {}", run.id)
+            run_status = await scheduler.call(
+                "runs",
+                client.beta.threads.runs.retrieve,
                 thread_id=thread_id,
                 run_id=run.id
             )
-            logger.debug(f"Current status of the run: {run_status.status}")
+            logger.debug("Current status of the run: {}", run_status.status)
+            run_timer.transition(run_status.status)
 
             if run_status.status == "requires_action":
                 logger.debug("Run requires action. Executing specified functions in parallel...")
                 tool_calls = run_status.required_action.submit_tool_outputs.tool_calls
-                logger.debug(f"Tool calls to process: {tool_calls}")
+                logger.opt(lazy=True).debug("Tool calls to process: {}", lambda: summarize(tool_calls))
                 tasks = [process_tool_call(tool_call, from_user) for tool_call in tool_calls]
-                tool_outputs = await asyncio.gather(*tasks)
-                logger.debug(f"Tool outputs: {tool_outputs}")
+                with stage("tool_execution"):
+                    tool_outputs = await asyncio.gather(*tasks)
+                logger.opt(lazy=True).debug("Tool outputs: {}", lambda: summarize(tool_outputs))
 
-                logger.debug(f"Submitting tool outputs for run ID: {run.id}")
-                await client.beta.threads.runs.submit_tool_outputs(
+                logger.debug("Submitting tool outputs for run ID: {}", run.id)
+                await scheduler.call(
+                    "runs",
+                    client.beta.threads.runs.submit_tool_outputs,
                     thread_id=thread_id,
                     run_id=run.id,
                     tool_outputs=tool_outputs
                 )
                 logger.debug("Tool outputs submitted.")
 
-            elif run_status.status in ["completed", "failed", "cancelled"]:
-                logger.debug(f"Fetching the latest message added by the assistant for thread ID: {thread_id}")
-                messages_response = await client.beta.threads.messages.list(
-                    thread_id=thread_id,
-                    order="desc"
-                )
-                messages = messages_response.data  # Access the data attribute directly
-
-                # Iterate through messages
-                latest_assistant_message = next((message for message in messages if message.role == "assistant"), None)
-
-                logger.debug(f"Latest assistant message: {latest_assistant_message}")
-
-                if latest_assistant_message:
-                    for content in latest_assistant_message.content:
-                        logger.debug(f"Processing content: {content}")
-                        if content.type == "text":
-                            text_value = content.text.value
-                            logger.debug(f"Original text value: {text_value}")
-                            text_value = await replace_file_ids_with_urls(text_value)
-                            logger.debug(f"Text value after replacing file IDs with URLs: {text_value}")
-
-                            # Format the text for Slack
-                            text_value = format_for_slack(text_value)
-                            logger.debug(f"Text value after Slack formatting: {text_value}")
-
-                            for annotation in content.text.annotations:
-                                logger.debug(f"Processing annotation: {annotation}")
-                                if annotation.type == "file_citation":
-                                    cited_file = await client.files.retrieve(annotation.file_citation.file_id)
-                                    logger.debug(f"Cited file: {cited_file}")
-                                    citation_text = f"[Cited from {cited_file.filename}]"
-                                    text_value = text_value.replace(annotation.text, citation_text)
-                                    logger.debug(f"Text value after replacing file citation: {text_value}")
-                                elif annotation.type == "file_path":
-                                    file_info = await client.files.retrieve(annotation.file_path.file_id)
-                                    logger.debug(f"File info: {file_info}")
-                                    download_link = f"<https://platform.openai.com/files/{file_info.id}|Download {file_info.filename}>"
-                                    text_value = text_value.replace(annotation.text, download_link)
-                                    logger.debug(f"Text value after replacing file path: {text_value}")
-                            response_texts.append(text_value)
-                            logger.debug(f"Appended text value to response_texts: {text_value}")
-                        elif content.type == "file":
-                            file_id = content.file.file_id
-                            file_mime_type = content.file.mime_type
-                            logger.debug(f"File ID: {file_id}, MIME type: {file_mime_type}")
-                            response_files.append((file_id, file_mime_type))
-
-                    for file_id, mime_type in response_files:
-                        try:
-                            logger.debug(f"Retrieving content for file ID: {file_id} with MIME type: {mime_type}")
-                            file_response = await client.files.content(file_id)
-                            file_content = file_response.content if hasattr(file_response, 'content') else file_response
-                            logger.debug(f"File content retrieved: {file_content}")
-                            extensions = {
-                                "text/x-c": ".c", "text/x-csharp": ".cs", "text/x-c++": ".cpp",
-                                "application/msword": ".doc", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
-                                "text/html": ".html", "text/x-java": ".java", "application/json": ".json",
-                                "text/markdown": ".md", "application/pdf": ".pdf", "text/x-php": ".php",
-                                "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
-                                "text/x-python": ".py", "text/x-script.python": ".py", "text/x-ruby": ".rb",
-                                "text/x-tex": ".tex", "text/plain": ".txt", "text/css": ".css",
-                                "text/javascript": ".js", "application/x-sh": ".sh", "application/typescript": ".ts",
-                                "application/csv": ".csv", "image/jpeg": ".jpeg", "image/gif": ".gif",
-                                "image/png": ".png", "application/x-tar": ".tar",
-                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
-                                "application/xml": "text/xml", "application/zip": ".zip"
-                            }
-                            file_extension = extensions.get(mime_type, ".bin")
-                            logger.debug(f"File extension determined: {file_extension}")
-
-                            local_file_path = f"./downloaded_file_{file_id}{file_extension}"
-                            with open(local_file_path, "wb") as local_file:
-                                local_file.write(file_content)
-                            logger.debug(f"File saved locally at {local_file_path}")
-
-                        except Exception as e:
-                            logger.error(f"Failed to retrieve content for file ID: {file_id}. Error: {e}")
+            elif run_status.status in TERMINAL_RUN_STATUSES:
+                active_run_id = None
+                logger.debug("Fetching the messages added by run {} to thread ID: {}", run.id, thread_id)
+                # Only this run's messages, so the request stays small however long the thread is
+                with stage("messages_list"):
+                    messages_response = await scheduler.call(
+                        "messages",
+                        client.beta.threads.messages.list,
+                        thread_id=thread_id,
+                        run_id=run.id,
+                        order="asc"
+                    )
+                assistant_messages = [message for message in messages_response.data if message.role == "assistant"]
+                message_count += len(assistant_messages)
+
+                logger.opt(lazy=True).debug("Assistant messages of the run: {}", lambda: summarize(assistant_messages))
+
+                for message in assistant_messages:
+                    await collect_message_content(message, response_texts, response_files, response_markdown)
+                downloaded_files = await download_response_files(response_files)
+
+                record_run(run_status.status)
+                break
 
+            elif time.monotonic() >= deadline:
+                logger.warning(f"Run {run.id} still {run_status.status} after {RUN_TIMEOUT:g}s, cancelling it")
+                active_run_id = None
+                await cancel_run(thread_id, run.id)
+                record_run("timeout")
                 break
             await asyncio.sleep(1)
 
-        logger.debug(f"Returning response texts: {response_texts} and in-memory files: {in_memory_files}, Thread ID: {thread_id}")
-        return {"text": response_texts, "in_memory_files": in_memory_files, "thread_id": thread_id}
+        logger.debug("Returning {} response texts and {} files, Thread ID: {}", len(response_texts), len(downloaded_files), thread_id)
+        return {"text": response_texts, "markdown": response_markdown, "files": downloaded_files, "thread_id": thread_id, "message_count": message_count}
 
+    except asyncio.CancelledError:
+        if active_run_id is not None:
+            await cancel_run(thread_id, active_run_id)
+        raise
     except Exception as e:
         logger.error(f"An error occurred: {e}")
-        return {"text": [], "in_memory_files": [], "thread_id": thread_id}
\ No newline at end of file
+        record_run("error")
+        return {"text": [], "markdown": [], "files": [], "thread_id": thread_id, "message_count": message_count}
@@ -0,0 +1,168 @@
+"""Micro-benchmark for the Markdown to Slack mrkdwn renderer.
+
+Compares `slack_format.format_for_slack` with the regex chain it replaced
+over synthetic assistant answers of increasing size, and reports the time
+per kilobyte so linear scaling is easy to check. Three corpora are used: a
+typical prose-heavy status answer, a markup-heavy one where nearly every
+line carries list, emphasis, code or link syntax, and a single long line
+of unclosed emphasis, strike and link openers, the worst case for a
+renderer that searches ahead for closing delimiters.
+
+The renderer is as fast as the regex chain or faster on the typical and
+markup-heavy corpora, but about 5x slower on the long-line one (roughly
+0.6 ms/KB against 0.12 ms/KB): every unclosed opener searches up to
+MAX_INLINE_SPAN characters for its closer, whereas the chain's patterns
+only find the closers that happen to follow. Time per KB stays flat there
+too, so a line of unclosed openers costs linear time, not quadratic.
+
+Before timing anything, the renderer's output is checked against a few
+known cases, including bold that the regex chain turned into italics.
+
+Usage:
+    python benchmarks/bench_format.py [--sizes 100 200 400 800] [--repeat 5]
+"""
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from slack_format import format_for_slack, format_for_slack_blocks, split_for_slack  # noqa: E402
+
+TYPICAL_ANSWER = """Here is the latest on the **Cobrand** program for week {index}. Overall the initiative remains on
+track, with the partner integration entering its final testing phase and the marketing launch plan approved
+by the steering committee on Tuesday. The main open risk is the vendor's data-sharing agreement, which legal
+expects to close by the end of the month【4:{index}†source】.
+
+### Key updates
+- **Integration:** end-to-end testing started in staging; 42 of 57 test cases pass and the remaining
+  failures are tracked in the defect log.
+- **Marketing:** the launch creative was approved and the email campaign is scheduled for next month.
+- **Finance:** spend is 3% under the quarterly forecast, mainly due to delayed contractor onboarding.
+
+1. Confirm the go-live date with the partner team.
+2. Finalize the customer service scripts and training schedule.
+
+Let me know if you would like a deeper summary of any of these workstreams or the open action items.
+
+"""
+
+MARKUP_HEAVY_ANSWER = """## Weekly status for **Project {index}**
+
+The team closed *most* of the open items this week. See [the tracker](https://example.com/tracker?id={index}&view=all)
+and the attached summary in file-abc{index}. Key numbers: 3 * 4 = 12, revenue > plan & costs < budget.
+
+1. Finished the `migrate_orders` job for region {index}
+2. Reviewed **cost _savings_** with finance
+3. ~~Blocked~~ on vendor access
+
+- Owner: snake_case_owner_{index}
+  - Backup: __Alex__
+* Next review on Friday
+
+> Note: numbers are preliminary【4:{index}†source】
+
+```python
+def summarize(rows):
+    return sum(row["total"] * 2 for row in rows)  # <draft>
+```
+
+---
+"""
+
+
+# Repeated on one line, without a newline, up to the requested size
+LONG_LINE_ANSWER = "**open{index} __open{index} ~~open{index} [open{index} <https://example.com/{index}|open{index} "
+
+# Markdown and the mrkdwn it must render to
+REGRESSION_CASES = [
+    ("**Cobrand** is *on track*", "*Cobrand* is _on track_"),
+    ("Reviewed **cost _savings_** with finance", "Reviewed *cost _savings_* with finance"),
+    ("__Alex__ and _Sam_", "*Alex* and _Sam_"),
+    ("~~Blocked~~ on `migrate_orders`", "~Blocked~ on `migrate_orders`"),
+    ("[the tracker](https://example.com/t?a=1&b=2)", "<https://example.com/t?a=1&amp;b=2|the tracker>"),
+    ("3 * 4 = 12 and snake_case_name", "3 * 4 = 12 and snake_case_name"),
+    ("revenue > plan & costs < budget", "revenue &gt; plan &amp; costs &lt; budget"),
+    ("***Go-live*** is confirmed", "*_Go-live_* is confirmed"),
+    ("[the spec](https://example.com/wiki/Spec_(draft))", "<https://example.com/wiki/Spec_(draft)|the spec>"),
+    ("**open __open ~~open [open " * 50 + "\n**bold**", "**open __open ~~open [open " * 50 + "\n*bold*"),
+]
+
+
+def check_rendering():
+    """Exits with an error if the renderer's output differs from the expected mrkdwn."""
+    failures = [(text, expected, format_for_slack(text)) for text, expected in REGRESSION_CASES]
+    failures = [failure for failure in failures if failure[1] != failure[2]]
+    for text, expected, actual in failures:
+        print(f"Rendering mismatch for {text[:60]!r}:\n  expected {expected[:80]!r}\n  got      {actual[:80]!r}")
+    if failures:
+        sys.exit(1)
+
+
+def legacy_format_for_slack(text):
+    """The sequential regex chain previously used by assistants.format_for_slack."""
+    text = re.sub(r'\*\*(.*?)\*\*', r'*\1*', text)
+    text = re.sub(r'\*(.*?)\*', r'_\1_', text)
+    text = re.sub(r'~~(.*?)~~', r'\1', text)
+    text = re.sub(r'`(.*?)`', r'\1', text)
+    text = re.sub(r'^> (.*)', r'\n>\1', text, flags=re.MULTILINE)
+    text = re.sub(r'```(.*?)```', r'\1', text, flags=re.DOTALL)
+    text = re.sub(r'(\d+)\. ', r'\1. \n', text)
+    text = re.sub(r'^\* ', r'• ', text, flags=re.MULTILINE)
+    text = re.sub(r'^# (.*?)\n', r'*\1*\n', text)
+    text = re.sub(r'^## (.*?)\n', r'_\1_\n', text)
+    text = re.sub(r'### (.*?)\n', r'*\1*\n', text)
+    text = re.sub(r'#### (.*?)\n', r'_\1_\n', text)
+    return text
+
+
+CORPORA = {"typical": TYPICAL_ANSWER, "markup-heavy": MARKUP_HEAVY_ANSWER, "long-line": LONG_LINE_ANSWER}
+
+
+def build_answer(size_kb, template=MARKUP_HEAVY_ANSWER):
+    pieces = []
+    length = 0
+    index = 0
+    while length < size_kb * 1024:
+        piece = template.format(index=index)
+        pieces.append(piece)
+        length += len(piece)
+        index += 1
+    return "".join(pieces)
+
+
+def best_time(function, text, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 200, 400, 800], help="Answer sizes in KB")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the best is reported")
+    args = parser.parse_args()
+    check_rendering()
+
+    renderers = [
+        ("legacy regex chain", legacy_format_for_slack),
+        ("format_for_slack", format_for_slack),
+        ("split_for_slack", split_for_slack),
+        ("format_for_slack_blocks", format_for_slack_blocks),
+    ]
+    print(f"{'corpus':<14}{'renderer':<26}{'size KB':>8}{'ms':>10}{'us/KB':>10}")
+    for corpus, template in CORPORA.items():
+        for name, function in renderers:
+            for size_kb in args.sizes:
+                text = build_answer(size_kb, template)
+                elapsed = best_time(function, text, args.repeat)
+                print(f"{corpus:<14}{name:<26}{size_kb:>8}{elapsed * 1000:>10.2f}{elapsed * 1e6 / size_kb:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""End-to-end load test of the bot against local OpenAI and Slack stand-ins.
+
+Starts the fake services from `fake_services.py` in a child process, points
+the bot at them, and drives `message_handler` with synthetic user traffic:
+messages arrive at `--rate` per second (exponentially distributed, from a
+fixed seed, so a scenario replays identically) round-robin across
+`--users` users. Reports answer latency percentiles from message receipt
+to the last Slack call, answered runs per second, OpenAI and Slack calls
+per answer, file downloads from OpenAI and uploads to Slack per answer,
+and the bot process's peak RSS and thread count.
+
+Usage:
+    python benchmarks/bench_load.py [--scenario baseline] [--messages 200] [--users 50] [--rate 20] [--json results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from slack_sdk.errors import SlackApiError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import fake_services  # noqa: E402
+
+# Each scenario sets the fake services' behaviour and the bot's environment
+SCENARIOS = {
+    "baseline": {"behaviour": {}, "environment": {}},
+    "polling": {"behaviour": {}, "environment": {"STREAMING_RESPONSES": "false"}},
+    "tools": {"behaviour": {"tool_rounds": 2, "tools_per_round": 3}, "environment": {}},
+    "citations": {"behaviour": {"citations": 20, "files": 5, "answer_chars": 6000}, "environment": {}},
+    "generated-files": {"behaviour": {"files": 2, "images": 1, "file_bytes": 512 * 1024}, "environment": {}},
+    "long-answers": {"behaviour": {"answer_chars": 20000, "stream_chunks": 200}, "environment": {"SLACK_OUTPUT_MODE": "blocks"}},
+    "slow-runs": {"behaviour": {"queue_time": 1.0, "run_time": 5.0}, "environment": {}},
+    "rate-limited": {"behaviour": {"rate_limit_rate": 0.2, "retry_after": 0.5}, "environment": {}},
+    "slack-rate-limited": {"behaviour": {"slack_rate_limit_rate": 0.1}, "environment": {}},
+    "fan-out": {"behaviour": {}, "environment": {}, "prompt_prefix": "all: "},
+    "long-threads": {"behaviour": {}, "environment": {"THREAD_MAX_MESSAGES": "6", "THREAD_TRUNCATE_MESSAGES": "10"}},
+    "fan-out-cached": {"behaviour": {}, "environment": {"RESPONSE_CACHE": "true"}, "prompt_prefix": "all: "},
+}
+
+PROMPTS = [
+    "What is the latest on the Cobrand program?",
+    "Summarize the open risks for this week.",
+    "Which action items are overdue?",
+    "Give me the key takeaways from the last steering committee.",
+]
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def fetch_json(url, method="GET"):
+    request = urllib.request.Request(url, data=b"" if method == "POST" else None, method=method)
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+class ResourceSampler:
+    """Samples the process's resident memory and thread count in the background."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="resource-sampler", daemon=True)
+
+    def sample(self):
+        rss, threads = 0, threading.active_count()
+        try:
+            with open("/proc/self/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) * 1024
+                    elif line.startswith("Threads:"):
+                        threads = int(line.split()[1])
+        except OSError:
+            import resource
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.peak_rss = max(self.peak_rss, rss)
+        self.peak_threads = max(self.peak_threads, threads)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def configure_environment(args, scenario, openai_port, slack_port, directory):
+    users = [f"UBENCH{index:04d}" for index in range(args.users)]
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-bench-0000000000000000",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+        "SLACK_API_URL": f"http://127.0.0.1:{slack_port}/api/",
+        "SLACK_BOT_TOKEN": "xoxb-bench",
+        "SLACK_APP_TOKEN": "xapp-bench",
+        "SLACK_SIGNING_SECRET": "bench",
+        "AUTHORIZED_USER_IDS": ",".join(users),
+        "ASSISTANT_ID": "asst_bench",
+        "LOG_MODE": "production",
+        "LOG_LEVEL": "WARNING",
+        "LOG_FILE": os.path.join(directory, "app.log"),
+        "FILE_STORE_DIR": os.path.join(directory, "files"),
+        "SESSION_STORE": "memory",
+        "WORKER_CONCURRENCY": str(args.concurrency),
+        "WORKER_QUEUE_LIMIT": str(args.queue_limit),
+        **scenario["environment"],
+    })
+    return users
+
+
+def run_scenario(args):
+    scenario = SCENARIOS[args.scenario]
+    ports_queue = multiprocessing.Queue()
+    services = multiprocessing.Process(
+        target=fake_services.serve, args=(scenario["behaviour"], ports_queue), name="fake-services", daemon=True
+    )
+    services.start()
+    openai_port, slack_port = ports_queue.get(timeout=10)
+
+    with tempfile.TemporaryDirectory() as directory:
+        users = configure_environment(args, scenario, openai_port, slack_port, directory)
+        import app
+
+        submitted = {}
+        latencies = []
+        done = threading.Condition()
+        process_and_respond = app.conversation_queue.handler
+
+        async def timed_handler(user_id, batch):
+            try:
+                await process_and_respond(user_id, batch)
+            finally:
+                finished = time.perf_counter()
+                with done:
+                    latencies.extend(finished - submitted[item["ts"]] for item in batch)
+                    done.notify_all()
+
+        app.conversation_queue.handler = timed_handler
+        app.worker_pool.start()
+        for url in (f"http://127.0.0.1:{openai_port}/_reset", f"http://127.0.0.1:{slack_port}/_reset"):
+            fetch_json(url, method="POST")
+
+        rejected = 0
+        rng = random.Random(args.seed)
+        sampler = ResourceSampler()
+        sampler.start()
+        started = time.perf_counter()
+        next_arrival = started
+        for index in range(args.messages):
+            next_arrival += rng.expovariate(args.rate)
+            delay = next_arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            user_id = users[index % len(users)]
+            channel = f"D{user_id}"
+            ts = f"1700000000.{index:06d}"
+            replies = []
+
+            def say(text, **kwargs):
+                replies.append(text)
+                try:
+                    app.slack_app.client.chat_postMessage(channel=channel, text=text, **kwargs)
+                except SlackApiError:
+                    pass  # Bolt would log a failed acknowledgement reply and carry on
+
+            submitted[ts] = time.perf_counter()
+            app.message_handler(
+                message={"user": user_id, "text": scenario.get("prompt_prefix", "") + rng.choice(PROMPTS), "ts": ts, "channel": channel},
+                say=say,
+                ack=lambda: None
+            )
+            if any("too many requests" in reply for reply in replies):
+                rejected += 1
+
+        with done:
+            done.wait_for(lambda: len(latencies) + rejected >= args.messages, timeout=args.timeout)
+        elapsed = time.perf_counter() - started
+        sampler.stop()
+
+        openai_calls = fetch_json(f"http://127.0.0.1:{openai_port}/_stats")
+        slack_calls = fetch_json(f"http://127.0.0.1:{slack_port}/_stats")
+        app.worker_pool.shutdown()
+        app.user_sessions.close()
+        app.flush_logging()
+    services.terminate()
+
+    answered = len(latencies)
+    answers = max(answered, 1)
+    return {
+        "scenario": args.scenario,
+        "messages": args.messages,
+        "answered": answered,
+        "rejected": rejected,
+        "elapsed_s": elapsed,
+        "runs_per_s": answered / elapsed,
+        "latency_p50_s": percentile(latencies, 0.50),
+        "latency_p95_s": percentile(latencies, 0.95),
+        "latency_p99_s": percentile(latencies, 0.99),
+        "openai_calls_per_answer": sum(openai_calls.values()) / answers,
+        "slack_calls_per_answer": sum(slack_calls.values()) / answers,
+        "file_downloads_per_answer": openai_calls.get("GET /v1/files/{file}/content", 0) / answers,
+        "file_uploads_per_answer": slack_calls.get("upload", 0) / answers,
+        "openai_calls": openai_calls,
+        "slack_calls": slack_calls,
+        "peak_rss_mb": sampler.peak_rss / 1024 ** 2,
+        "peak_threads": sampler.peak_threads,
+    }
+
+
+def print_report(result):
+    print(f"scenario            {result['scenario']}")
+    print(f"messages            {result['messages']} sent, {result['answered']} answered, {result['rejected']} rejected")
+    print(f"throughput          {result['runs_per_s']:.2f} answers/s over {result['elapsed_s']:.1f}s")
+    print(
+        f"latency             p50 {result['latency_p50_s']:.3f}s  "
+        f"p95 {result['latency_p95_s']:.3f}s  p99 {result['latency_p99_s']:.3f}s"
+    )
+    print(f"OpenAI calls        {result['openai_calls_per_answer']:.2f} per answer")
+    for endpoint, count in sorted(result["openai_calls"].items()):
+        print(f"  {endpoint:<56}{count:>8}")
+    print(f"Slack calls         {result['slack_calls_per_answer']:.2f} per answer")
+    for method, count in sorted(result["slack_calls"].items()):
+        print(f"  {method:<56}{count:>8}")
+    print(f"file transfers      {result['file_downloads_per_answer']:.2f} downloads, {result['file_uploads_per_answer']:.2f} uploads per answer")
+    print(f"peak RSS            {result['peak_rss_mb']:.1f} MB")
+    print(f"peak threads        {result['peak_threads']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="baseline")
+    parser.add_argument("--messages", type=int, default=200, help="Messages to send")
+    parser.add_argument("--users", type=int, default=50, help="Distinct users sending them")
+    parser.add_argument("--rate", type=float, default=20.0, help="Mean arrival rate in messages per second")
+    parser.add_argument("--concurrency", type=int, default=8, help="WORKER_CONCURRENCY for the bot")
+    parser.add_argument("--queue-limit", type=int, default=1000, help="WORKER_QUEUE_LIMIT for the bot")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for arrival times and prompts")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for outstanding answers")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    result = run_scenario(args)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,518 @@
+"""Local stand-ins for the OpenAI Assistants/Files API and the Slack Web API.
+
+The fake OpenAI server implements just enough of the threads, messages,
+runs (polling and streaming) and files endpoints for the bot to answer a
+message, with configurable run timings, `requires_action` rounds, citation
+annotations, generated files and images per answer, and answer size.
+Generated files arrive the way the real API sends them: as `file_path`
+annotations on the answer text and as `image_file` content parts. The
+fake Slack server accepts every Web API method the bot calls, plus the
+file upload URL. Both count the calls they receive per endpoint;
+`GET /_stats` returns the counts and `POST /_reset` clears them.
+
+Usage:
+    python benchmarks/fake_services.py [--openai-port 8801] [--slack-port 8802] [--run-time 0.5] ...
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_BEHAVIOUR = {
+    "queue_time": 0.05,       # seconds a run stays queued
+    "run_time": 0.5,          # seconds a run stays in progress, per round
+    "tool_rounds": 0,         # requires_action rounds before the answer
+    "tools_per_round": 1,     # tool calls per requires_action round
+    "citations": 2,           # file_citation annotations per answer
+    "files": 0,               # generated files, as file_path annotations, per answer
+    "images": 0,              # generated images, as image_file content parts, per answer
+    "answer_chars": 1500,     # approximate answer length
+    "stream_chunks": 20,      # text deltas per streamed answer
+    "slack_latency": 0.02,    # seconds each Slack Web API call takes
+    "file_bytes": 64 * 1024,  # size of a file's content
+    "rate_limit_rate": 0.0,   # fraction of OpenAI requests answered with 429
+    "retry_after": 0.5,       # Retry-After seconds sent with a 429
+    "slack_rate_limit_rate": 0.0,  # fraction of Slack Web API calls answered with 429
+}
+
+ANSWER_PARAGRAPH = (
+    "The **{topic}** workstream is on track for week {index}. Integration testing continues in staging, "
+    "with most test cases passing and the remaining defects tracked in the log. Key actions:\n"
+    "- Confirm the go-live date with the partner team\n"
+    "- Finalize the `support_playbook` and training schedule\n\n"
+)
+
+
+def normalize_path(path):
+    """Collapses IDs in a request path so calls can be counted per endpoint."""
+    return re.sub(r"/(thread|run|msg|file|call|asst|vs)[_-][A-Za-z0-9]+", r"/{\1}", path)
+
+
+def build_answer(behaviour, index, answer_id=0):
+    """Returns the text and annotations of a synthetic assistant answer.
+
+    `answer_id` keeps the IDs of generated files unique across all answers.
+    """
+    text = ""
+    annotations = []
+    paragraph = 0
+    while len(text) < behaviour["answer_chars"] or paragraph < behaviour["citations"] + behaviour["files"]:
+        text += ANSWER_PARAGRAPH.format(topic="Cobrand", index=index)
+        if paragraph < behaviour["citations"]:
+            marker = f"【4:{paragraph}†source】"
+            annotations.append({
+                "type": "file_citation",
+                "text": marker,
+                "start_index": len(text),
+                "end_index": len(text) + len(marker),
+                "file_citation": {"file_id": f"file-cite{paragraph}", "quote": ""}
+            })
+            text += marker + "\n\n"
+        elif paragraph < behaviour["citations"] + behaviour["files"]:
+            number = paragraph - behaviour["citations"]
+            marker = f"sandbox:/mnt/data/report_{index}_{number}.csv"
+            annotations.append({
+                "type": "file_path",
+                "text": marker,
+                "start_index": len(text) + 1,
+                "end_index": len(text) + 1 + len(marker),
+                "file_path": {"file_id": f"file-out{answer_id}x{number}"}
+            })
+            text += f"[report]({marker})\n\n"
+        paragraph += 1
+    return text, annotations
+
+
+class FakeOpenAI:
+    """In-memory state of the fake Assistants API."""
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.threads = {}
+        self.runs = {}
+        self.calls = Counter()
+
+    def new_id(self, prefix):
+        return f"{prefix}_{next(self.ids)}"
+
+    def message_object(self, thread_id, role, text, annotations=(), run_id=None, message_id=None, image_file_ids=()):
+        content = [{"type": "text", "text": {"value": text, "annotations": list(annotations)}}]
+        content.extend({"type": "image_file", "image_file": {"file_id": file_id, "detail": None}} for file_id in image_file_ids)
+        return {
+            "id": message_id or self.new_id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "status": "completed",
+            "assistant_id": None,
+            "run_id": run_id,
+            "attachments": [],
+            "metadata": {},
+            "completed_at": None,
+            "incomplete_at": None,
+            "incomplete_details": None,
+            "content": content
+        }
+
+    def run_object(self, run):
+        required_action = None
+        if run["status"] == "requires_action":
+            required_action = {
+                "type": "submit_tool_outputs",
+                "submit_tool_outputs": {"tool_calls": [
+                    {"id": self.new_id("call"), "type": "function", "function": {"name": "lookup", "arguments": "{}"}}
+                    for _ in range(self.behaviour["tools_per_round"])
+                ]}
+            }
+        return {
+            "id": run["id"],
+            "object": "thread.run",
+            "created_at": int(run["created"]),
+            "thread_id": run["thread_id"],
+            "assistant_id": run["assistant_id"],
+            "status": run["status"],
+            "required_action": required_action,
+            "model": run["model"],
+            "instructions": "",
+            "tools": [],
+            "metadata": {},
+            "last_error": None,
+            "expires_at": None,
+            "started_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "completed_at": None,
+            "incomplete_details": None,
+            "usage": None,
+            "temperature": None,
+            "top_p": None,
+            "max_prompt_tokens": None,
+            "max_completion_tokens": None,
+            "truncation_strategy": {"type": "auto", "last_messages": None},
+            "response_format": "auto",
+            "tool_choice": "auto",
+            "parallel_tool_calls": True
+        }
+
+    def create_run(self, thread_id, body):
+        run = {
+            "id": self.new_id("run"),
+            "thread_id": thread_id,
+            "assistant_id": body.get("assistant_id"),
+            "model": body.get("model") or "gpt-4o",
+            "status": "queued",
+            "created": time.time(),
+            "phase_started": time.time(),
+            "rounds_left": self.behaviour["tool_rounds"]
+        }
+        self.runs[run["id"]] = run
+        return run
+
+    def complete_run(self, run):
+        """Marks a run completed and adds its answer to the thread."""
+        messages = self.threads.setdefault(run["thread_id"], [])
+        answer_id = next(self.ids)
+        text, annotations = build_answer(self.behaviour, len(messages), answer_id)
+        image_file_ids = [f"file-img{answer_id}x{number}" for number in range(self.behaviour["images"])]
+        message = self.message_object(
+            run["thread_id"], "assistant", text, annotations, run_id=run["id"], image_file_ids=image_file_ids
+        )
+        messages.append(message)
+        run["status"] = "completed"
+        return message
+
+    def advance(self, run):
+        """Moves a polled run along its timeline."""
+        now = time.time()
+        if run["status"] == "queued" and now - run["phase_started"] >= self.behaviour["queue_time"]:
+            run["status"] = "in_progress"
+            run["phase_started"] += self.behaviour["queue_time"]
+        if run["status"] == "in_progress" and now - run["phase_started"] >= self.behaviour["run_time"]:
+            if run["rounds_left"]:
+                run["status"] = "requires_action"
+            else:
+                self.complete_run(run)
+
+
+class OpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        return json.loads(raw) if raw else {}
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def rate_limited(self):
+        """Answers 429 to a random `rate_limit_rate` share of requests."""
+        if random.random() >= self.state.behaviour["rate_limit_rate"]:
+            return False
+        with self.state.lock:
+            self.state.calls["429"] += 1
+        body = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}).encode()
+        self.send_response(429)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Retry-After", str(self.state.behaviour["retry_after"]))
+        self.end_headers()
+        self.wfile.write(body)
+        return True
+
+    def send_events(self, events):
+        """Streams server-sent events; each item is (event, data) or a delay in seconds."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for item in events:
+                if isinstance(item, (int, float)):
+                    time.sleep(item)
+                    continue
+                event, data = item
+                self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client abandoned the stream, e.g. after a fan-out deadline
+
+    def stream_run(self, run, resumed=False):
+        state = self.state
+        behaviour = state.behaviour
+        if not resumed:
+            yield "thread.run.created", state.run_object(run)
+            yield "thread.run.queued", state.run_object(run)
+            yield behaviour["queue_time"]
+        with state.lock:
+            run["status"] = "in_progress"
+        yield "thread.run.in_progress", state.run_object(run)
+        if run["rounds_left"]:
+            yield behaviour["run_time"]
+            with state.lock:
+                run["status"] = "requires_action"
+            yield "thread.run.requires_action", state.run_object(run)
+            return
+        with state.lock:
+            message = state.complete_run(run)
+        text = message["content"][0]["text"]["value"]
+        snapshot = dict(message, status="in_progress", content=[])
+        yield "thread.message.created", snapshot
+        chunks = max(behaviour["stream_chunks"], 1)
+        size = -(-len(text) // chunks)
+        for start in range(0, len(text), size):
+            yield behaviour["run_time"] / chunks
+            yield "thread.message.delta", {
+                "id": message["id"],
+                "object": "thread.message.delta",
+                "delta": {"content": [{"index": 0, "type": "text", "text": {"value": text[start:start + size], "annotations": []}}]}
+            }
+        yield "thread.message.completed", message
+        yield "thread.run.completed", state.run_object(run)
+
+    def do_GET(self):
+        state = self.state
+        path = urlparse(self.path).path
+        if path == "/_stats":
+            with state.lock:
+                return self.send_json(dict(state.calls))
+        if self.rate_limited():
+            return
+        with state.lock:
+            state.calls[f"GET {normalize_path(path)}"] += 1
+        if match := re.fullmatch(r"/v1/threads/([^/]+)/runs/([^/]+)", path):
+            with state.lock:
+                run = state.runs[match.group(2)]
+                state.advance(run)
+                return self.send_json(state.run_object(run))
+        if match := re.fullmatch(r"/v1/threads/([^/]+)/messages", path):
+            query = parse_qs(urlparse(self.path).query)
+            with state.lock:
+                messages = list(state.threads.get(match.group(1), []))
+            if "run_id" in query:
+                messages = [message for message in messages if message["run_id"] == query["run_id"][0]]
+            if query.get("order", ["desc"])[0] == "desc":
+                messages.reverse()
+            limit = int(query.get("limit", ["20"])[0])
+            return self.send_json({"object": "list", "data": messages[:limit], "has_more": len(messages) > limit})
+        if re.fullmatch(r"/v1/files/([^/]+)/content", path):
+            body = b"x" * state.behaviour["file_bytes"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            return self.wfile.write(body)
+        if match := re.fullmatch(r"/v1/files/([^/]+)", path):
+            return self.send_json(file_object(match.group(1)))
+        if path == "/v1/files":
+            return self.send_json({"object": "list", "data": [], "has_more": False})
+        if match := re.fullmatch(r"/v1/vector_stores/([^/]+)/files", path):
+            data = [vector_store_file_object(match.group(1), f"file-{match.group(1)[-4:]}{index}") for index in range(3)]
+            return self.send_json({"object": "list", "data": data, "has_more": False})
+        self.send_json({"error": {"message": f"Unknown endpoint {path}"}}, status=404)
+
+    def do_POST(self):
+        state = self.state
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if path == "/_reset":
+            with state.lock:
+                state.calls.clear()
+            return self.send_json({})
+        if self.rate_limited():
+            return
+        with state.lock:
+            state.calls[f"POST {normalize_path(path)}"] += 1
+        if path == "/v1/threads":
+            with state.lock:
+                thread_id = state.new_id("thread")
+                state.threads[thread_id] = [
+                    state.message_object(thread_id, seed["role"], seed["content"]) for seed in body.get("messages", [])
+                ]
+            return self.send_json({"id": thread_id, "object": "thread", "created_at": int(time.time()), "metadata": {}})
+        if match := re.fullmatch(r"/v1/threads/([^/]+)/messages", path):
+            with state.lock:
+                content = body.get("content")
+                message = state.message_object(match.group(1), "user", content if isinstance(content, str) else "")
+                state.threads.setdefault(match.group(1), []).append(message)
+            return self.send_json(message)
+        if match := re.fullmatch(r"/v1/threads/([^/]+)/runs", path):
+            with state.lock:
+                run = state.create_run(match.group(1), body)
+            if body.get("stream"):
+                return self.send_events(self.stream_run(run))
+            return self.send_json(state.run_object(run))
+        if path == "/v1/chat/completions":
+            return self.send_json({
+                "id": state.new_id("chatcmpl"),
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "gpt-4o"),
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {"role": "assistant", "content": "The user asked about the Cobrand program and its risks."}
+                }]
+            })
+        if match := re.fullmatch(r"/v1/threads/([^/]+)/runs/([^/]+)/submit_tool_outputs", path):
+            with state.lock:
+                run = state.runs[match.group(2)]
+                run["rounds_left"] -= 1
+                run["status"] = "in_progress"
+                run["phase_started"] = time.time()
+            if body.get("stream"):
+                return self.send_events(self.stream_run(run, resumed=True))
+            return self.send_json(state.run_object(run))
+        self.send_json({"error": {"message": f"Unknown endpoint {path}"}}, status=404)
+
+
+def vector_store_file_object(vector_store_id, file_id):
+    return {
+        "id": file_id,
+        "object": "vector_store.file",
+        "usage_bytes": 1024,
+        "created_at": 1700000000,
+        "vector_store_id": vector_store_id,
+        "status": "completed",
+        "last_error": None
+    }
+
+
+def file_object(file_id):
+    # Files written by the code interpreter keep their sandbox path as filename
+    if file_id.startswith("file-out"):
+        filename = f"/mnt/data/{file_id}.csv"
+    elif file_id.startswith("file-img"):
+        filename = f"/mnt/data/{file_id}.png"
+    else:
+        filename = f"{file_id}.pdf"
+    return {
+        "id": file_id,
+        "object": "file",
+        "bytes": 1024,
+        "created_at": 1700000000,
+        "filename": filename,
+        "purpose": "assistants",
+        "status": "processed"
+    }
+
+
+class SlackHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    behaviour = None
+    calls = None
+    lock = threading.Lock()
+    ts = itertools.count(1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/_stats":
+            with self.lock:
+                return self.send_json(dict(self.calls))
+        self.send_json({"ok": False, "error": "unknown_method"}, status=404)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        remaining = length
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024 ** 2)))
+        if path == "/_reset":
+            with self.lock:
+                self.calls.clear()
+            return self.send_json({})
+        method = path.rsplit("/", 1)[-1]
+        if not path.startswith("/upload/") and random.random() < self.behaviour["slack_rate_limit_rate"]:
+            with self.lock:
+                self.calls["429"] += 1
+            body = json.dumps({"ok": False, "error": "ratelimited"}).encode()
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Retry-After", "1")
+            self.end_headers()
+            return self.wfile.write(body)
+        with self.lock:
+            self.calls["upload" if path.startswith("/upload/") else method] += 1
+        time.sleep(self.behaviour["slack_latency"])
+        if path.startswith("/upload/"):
+            return self.send_json({"ok": True})
+        if method == "auth.test":
+            return self.send_json({"ok": True, "user_id": "UBOT", "bot_id": "BBOT", "team_id": "TBENCH", "user": "bot"})
+        if method in ("chat.postMessage", "chat.update"):
+            return self.send_json({"ok": True, "channel": "CBENCH", "ts": f"1800000000.{next(self.ts):06d}"})
+        if method == "files.getUploadURLExternal":
+            file_id = f"F{next(self.ts)}"
+            host, port = self.server.server_address[:2]
+            return self.send_json({"ok": True, "file_id": file_id, "upload_url": f"http://{host}:{port}/upload/{file_id}"})
+        self.send_json({"ok": True})
+
+
+def start_servers(behaviour=None, openai_port=0, slack_port=0, host="127.0.0.1"):
+    """Starts both fake servers on background threads.
+
+    Returns:
+        tuple: The OpenAI server and the Slack server.
+    """
+    behaviour = {**DEFAULT_BEHAVIOUR, **(behaviour or {})}
+    openai_handler = type("BoundOpenAIHandler", (OpenAIHandler,), {"state": FakeOpenAI(behaviour)})
+    slack_handler = type("BoundSlackHandler", (SlackHandler,), {"behaviour": behaviour, "calls": Counter()})
+    servers = (ThreadingHTTPServer((host, openai_port), openai_handler), ThreadingHTTPServer((host, slack_port), slack_handler))
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=f"fake-{server.server_address[1]}", daemon=True).start()
+    return servers
+
+
+def serve(behaviour, ports_queue, openai_port=0, slack_port=0):
+    """Runs both fake servers until the process is terminated, reporting their ports on `ports_queue`."""
+    openai_server, slack_server = start_servers(behaviour, openai_port, slack_port)
+    ports_queue.put((openai_server.server_address[1], slack_server.server_address[1]))
+    threading.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--openai-port", type=int, default=8801)
+    parser.add_argument("--slack-port", type=int, default=8802)
+    for name, default in DEFAULT_BEHAVIOUR.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args()
+    behaviour = {name: getattr(args, name) for name in DEFAULT_BEHAVIOUR}
+    start_servers(behaviour, args.openai_port, args.slack_port)
+    print(f"Fake OpenAI API on http://127.0.0.1:{args.openai_port}/v1, fake Slack API on http://127.0.0.1:{args.slack_port}/api/")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import threading
+from loguru import logger
+
+
+class ConversationQueue:
+    """Serializes work per conversation and coalesces messages that pile up behind a run.
+
+    Each conversation key (one per OpenAI thread) has at most one job in the
+    worker pool. Messages submitted while that job is waiting or running are
+    collected into a single pending batch, which the same job processes next,
+    so every thread has one in-flight run at a time and a burst of messages
+    costs one extra run instead of one run per message.
+    """
+
+    def __init__(self, worker_pool, handler):
+        """
+        Args:
+            worker_pool (WorkerPool): The pool that runs the per-conversation jobs.
+            handler (callable): Coroutine function called as `handler(key, batch)`
+                with the list of items collected for a conversation.
+        """
+        self.worker_pool = worker_pool
+        self.handler = handler
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._active = set()
+
+    def submit(self, key, item):
+        """Adds an item to the conversation's pending batch.
+
+        Returns:
+            int or None: The worker pool position if a new job was started for
+                the conversation, or None if the item joined a batch behind
+                work already queued or running for it.
+
+        Raises:
+            QueueFullError: If a new job was needed and the worker pool is full.
+        """
+        # The job is admitted under the lock, so no item joins a batch whose
+        # job the pool then rejects; WorkerPool.submit never blocks
+        with self._lock:
+            if key in self._active:
+                self._pending.setdefault(key, []).append(item)
+                logger.debug("Coalesced message into pending batch for {} ({} items)", key, len(self._pending[key]))
+                return None
+            position = self.worker_pool.submit(lambda: self._drain(key))
+            self._pending[key] = [item]
+            self._active.add(key)
+            return position
+
+    async def _drain(self, key):
+        while True:
+            with self._lock:
+                batch = self._pending.pop(key, None)
+                if not batch:
+                    self._active.discard(key)
+                    return
+            logger.debug("Processing batch of {} items for {}", len(batch), key)
+            try:
+                await self.handler(key, batch)
+            except Exception as e:
+                logger.exception(f"Failed to process batch for {key}: {e}")
@@ -0,0 +1,108 @@
+import asyncio
+from loguru import logger
+from metrics import labelled
+from response_cache import process_with_cache
+
+ANSWERED = "answered"
+NO_ANSWER = "no answer"
+TIMED_OUT = "timed out"
+
+
+async def fan_out(
+    query, assistants, on_result, from_user=None, max_concurrency=5, deadline=120.0,
+    response_cache=None, vector_store_ids=None
+):
+    """Sends one query to several assistants concurrently and reports each answer as it arrives.
+
+    Each assistant gets a fresh thread. At most `max_concurrency` runs are
+    in flight at once, and runs still going after `deadline` seconds are
+    abandoned, so the whole fan-out takes about as long as the slowest
+    assistant that finishes in time rather than the sum of all of them.
+    Abandoned runs are cancelled on OpenAI, except those going through
+    `response_cache`, which finish in the background and are cached.
+
+    Args:
+        query (str): The user's question.
+        assistants (dict): Maps a display name, such as the drumbeat, to an assistant ID.
+        on_result (callable): Coroutine function called as `on_result(name, response)`
+            for each answer, one at a time in completion order; the time it
+            takes does not count against `deadline`.
+        from_user (str, optional): The Slack user asking, passed on to tool calls.
+        response_cache (ResponseCache, optional): Answers repeated questions from memory.
+        vector_store_ids (dict, optional): Maps assistant IDs to the vector stores
+            whose file sets invalidate their cached answers.
+
+    Returns:
+        dict: Maps each name to ANSWERED, NO_ANSWER or TIMED_OUT.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def ask(name, assistant_id):
+        async with semaphore:
+            with labelled(name):
+                return await process_with_cache(
+                    response_cache, query, assistant_id, (vector_store_ids or {}).get(assistant_id),
+                    from_user=from_user, stream=True,
+                    # Fan-out answers are never followed up in their thread
+                    seed_thread=False
+                )
+
+    tasks = {asyncio.ensure_future(ask(name, assistant_id)): name for name, assistant_id in assistants.items()}
+    statuses = {}
+    # Answers are handed to one delivery task, so posting them neither
+    # counts against the deadline nor interleaves the parts of two answers
+    answers = asyncio.Queue()
+
+    async def deliver():
+        while (answer := await answers.get()) is not None:
+            try:
+                await on_result(*answer)
+            except Exception as e:
+                logger.exception(f"Failed to deliver the fan-out answer of {answer[0]}: {e}")
+
+    def collect(task):
+        name = tasks[task]
+        if task.exception() is not None:
+            logger.error(f"Fan-out query to {name} failed: {task.exception()}")
+            statuses[name] = NO_ANSWER
+            return
+        response = task.result()
+        statuses[name] = ANSWERED if response.get("text") or response.get("files") else NO_ANSWER
+        if statuses[name] == ANSWERED:
+            answers.put_nowait((name, response))
+
+    delivery = asyncio.ensure_future(deliver())
+    pending = set(tasks)
+    loop = asyncio.get_running_loop()
+    expires_at = loop.time() + deadline
+    try:
+        while pending:
+            remaining = expires_at - loop.time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                collect(task)
+    finally:
+        for task in pending:
+            if task.done() and not task.cancelled():
+                collect(task)
+                continue
+            task.cancel()
+            statuses[tasks[task]] = TIMED_OUT
+        await asyncio.gather(*pending, return_exceptions=True)
+        answers.put_nowait(None)
+        await delivery
+    logger.debug("Fan-out finished: {}", statuses)
+    return statuses
+
+
+def summarize_fan_out(statuses, deadline):
+    """Builds the closing status line of a fan-out answer."""
+    groups = {status: [name for name, value in statuses.items() if value == status] for status in (ANSWERED, NO_ANSWER, TIMED_OUT)}
+    lines = [f"Answered by {len(groups[ANSWERED])} of {len(statuses)} drumbeats."]
+    if groups[NO_ANSWER]:
+        lines.append(f"No answer from: {', '.join(groups[NO_ANSWER])}.")
+    if groups[TIMED_OUT]:
+        lines.append(f"Timed out after {deadline:g}s: {', '.join(groups[TIMED_OUT])}.")
+    return "\n".join(lines)
@@ -1,40 +1,345 @@
+import asyncio
+import hashlib
+import mimetypes
 import os
-from openai import AsyncOpenAI
+import re
+import time
+from collections import OrderedDict
+from openai import NotFoundError
 from loguru import logger
+from logging_config import summarize
+from openai_client import BACKGROUND_PRIORITY, USER_PRIORITY, client, scheduler
 
-api_key = os.environ.get("OPENAI_API_KEY")
-logger.debug(f"Retrieved API key from environment: {api_key}")
+# OpenAI file IDs look like "file-" followed by an alphanumeric suffix
+FILE_ID_PATTERN = re.compile(r"\bfile-[A-Za-z0-9]+\b")
 
-client = AsyncOpenAI(api_key=api_key)
-logger.debug("Initialized OpenAI client")
+class FileMetadataCache:
+    """An LRU cache of OpenAI file metadata with per-entry expiry.
 
-async def list_files():
+    Unknown IDs are cached as misses for `negative_ttl` seconds so text that
+    merely looks like a file ID does not trigger a lookup on every answer.
+    Concurrent lookups of the same ID share a single request, and at most
+    `max_concurrency` lookups are in flight at once.
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600.0, negative_ttl=300.0, refresh_interval=300.0, max_concurrency=8):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_interval = refresh_interval
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._last_created_at = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, file_id, file_info):
+        ttl = self.ttl if file_info is not None else self.negative_ttl
+        self._entries[file_id] = (time.monotonic() + ttl, file_info)
+        self._entries.move_to_end(file_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def peek(self, file_id):
+        """Returns (hit, file_info) for a cached ID without making any API call."""
+        entry = self._entries.get(file_id)
+        if entry is None:
+            return False, None
+        expires_at, file_info = entry
+        if expires_at < time.monotonic():
+            del self._entries[file_id]
+            return False, None
+        self._entries.move_to_end(file_id)
+        return True, file_info
+
+    async def _fetch(self, file_id):
+        try:
+            async with self._semaphore:
+                file_info = await retrieve_file(file_id)
+        except NotFoundError:
+            logger.debug("File ID {} does not exist, caching the miss", file_id)
+            file_info = None
+        self._store(file_id, file_info)
+        return file_info
+
+    async def get(self, file_id):
+        """Returns the metadata for `file_id`, or None if no such file exists."""
+        hit, file_info = self.peek(file_id)
+        if hit:
+            return file_info
+        task = self._inflight.get(file_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(file_id))
+            self._inflight[file_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(file_id, None))
+        return await task
+
+    async def get_many(self, file_ids):
+        """Returns a dict mapping each existing file ID in `file_ids` to its metadata."""
+        file_ids = list(dict.fromkeys(file_ids))
+        results = await asyncio.gather(*(self.get(file_id) for file_id in file_ids), return_exceptions=True)
+        found = {}
+        for file_id, result in zip(file_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to retrieve metadata for file ID {file_id}: {result}")
+            elif result is not None:
+                found[file_id] = result
+        return found
+
+    async def refresh(self):
+        """Adds files created since the last refresh and drops cached files that were deleted."""
+        files = await list_files(priority=BACKGROUND_PRIORITY)
+        current_ids = set()
+        added = 0
+        newest = self._last_created_at
+        for file_info in files:
+            current_ids.add(file_info.id)
+            if file_info.created_at > self._last_created_at:
+                self._store(file_info.id, file_info)
+                added += 1
+                newest = max(newest, file_info.created_at)
+            elif file_info.id in self._entries:
+                self._store(file_info.id, file_info)
+        for file_id, (_, file_info) in list(self._entries.items()):
+            if file_info is not None and file_id not in current_ids:
+                del self._entries[file_id]
+        self._last_created_at = newest
+        logger.debug("File metadata cache refreshed: {} new files, {} cached entries", added, len(self._entries))
+
+    async def run_background_refresh(self):
+        """Refreshes the cache every `refresh_interval` seconds until cancelled."""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"File metadata cache refresh failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+async def list_files(priority=USER_PRIORITY):
     logger.debug("Listing files from OpenAI")
-    response = await client.files.list()
-    logger.debug(f"Received response from OpenAI: {response}")
+    response = await scheduler.call("files", client.files.list, priority=priority)
+    logger.debug("Received {} files from OpenAI", len(response.data))
     return response.data # Access the 'data' attribute
 
 async def retrieve_file(file_id):
-    logger.debug(f"Retrieving file with ID: {file_id}")
-    response = await client.files.retrieve(file_id)
-    logger.debug(f"Received file data: {response}")
+    logger.debug("Retrieving file with ID: {}", file_id)
+    response = await scheduler.call("files", client.files.retrieve, file_id)
+    logger.opt(lazy=True).debug("Received file data: {}", lambda: summarize(response))
     return response
 
-async def get_file_url(file_id):
-    logger.debug(f"Getting URL for file ID: {file_id}")
-    file_info = await retrieve_file(file_id)
-    file_url = f"https://platform.openai.com/files/{file_info.id}"
-    logger.debug(f"Constructed file URL: {file_url}")
-    return file_url
-
-async def replace_file_ids_with_urls(text):
-    logger.debug(f"Replacing file IDs with URLs in text: {text}")
-    files = await list_files()  # await the async function call
-    for file in files: 
-        file_id = file.id
-        logger.debug(f"Processing file ID: {file_id}")
-        file_url = await get_file_url(file_id)  # await the async function call
-        logger.debug(f"Replacing file ID {file_id} with URL {file_url}")
-        text = text.replace(file_id, file_url)
-    logger.debug(f"Final text after replacements: {text}")
-    return text
\ No newline at end of file
+file_cache = FileMetadataCache(
+    max_entries=int(os.environ.get("FILE_CACHE_MAX_ENTRIES", "10000")),
+    ttl=float(os.environ.get("FILE_CACHE_TTL", "3600")),
+    refresh_interval=float(os.environ.get("FILE_CACHE_REFRESH_INTERVAL", "300")),
+    max_concurrency=int(os.environ.get("FILE_LOOKUP_CONCURRENCY", "8")),
+)
+
+MIME_EXTENSIONS = {
+    "text/x-c": ".c", "text/x-csharp": ".cs", "text/x-c++": ".cpp",
+    "application/msword": ".doc", "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+    "text/html": ".html", "text/x-java": ".java", "application/json": ".json",
+    "text/markdown": ".md", "application/pdf": ".pdf", "text/x-php": ".php",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": ".pptx",
+    "text/x-python": ".py", "text/x-script.python": ".py", "text/x-ruby": ".rb",
+    "text/x-tex": ".tex", "text/plain": ".txt", "text/css": ".css",
+    "text/javascript": ".js", "application/x-sh": ".sh", "application/typescript": ".ts",
+    "application/csv": ".csv", "text/csv": ".csv", "image/jpeg": ".jpeg", "image/gif": ".gif",
+    "image/png": ".png", "application/x-tar": ".tar",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": ".xlsx",
+    "application/xml": ".xml", "text/xml": ".xml", "application/zip": ".zip"
+}
+
+class FileContentCache:
+    """A content-addressed on-disk cache for files downloaded from OpenAI.
+
+    Downloads are streamed to disk in chunks while being hashed, then stored
+    under their SHA-256 digest, so identical content is kept once. When the
+    cache grows past `max_bytes`, the least recently used files are evicted;
+    files used within the last `min_age` seconds are never evicted, so an
+    upload in progress keeps its file.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, chunk_size=1024 ** 2, min_age=300.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.min_age = min_age
+        self._paths = {}
+        self._locks = {}
+
+    async def download(self, file_id, mime_type=None):
+        """Streams a file's content into the cache.
+
+        Returns:
+            dict: The `file_id`, local `path`, `filename`, `mime_type` and `size` of the file.
+        """
+        # The lock is shared by every caller for the file and dropped only when
+        # the last one is done, so two downloads never write the same temp file
+        entry = self._locks.setdefault(file_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                path = self._paths.get(file_id)
+                if path and os.path.exists(path):
+                    os.utime(path)
+                    logger.debug("File ID {} served from the local cache at {}", file_id, path)
+                else:
+                    path = await self._stream_to_disk(file_id, mime_type)
+                    self._paths[file_id] = path
+                    await asyncio.to_thread(self.evict)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._locks.pop(file_id, None)
+
+        file_info = await file_cache.get(file_id)
+        extension = MIME_EXTENSIONS.get(mime_type, os.path.splitext(path)[1])
+        filename = os.path.basename(file_info.filename) if file_info else f"{file_id}{extension}"
+        return {
+            "file_id": file_id,
+            "path": path,
+            "filename": filename,
+            "mime_type": mime_type,
+            "size": os.path.getsize(path)
+        }
+
+    async def _stream_to_disk(self, file_id, mime_type):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f".{file_id}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, "wb") as local_file:
+                async with scheduler.stream("files", lambda: client.files.with_streaming_response.content(file_id)) as response:
+                    async for chunk in response.iter_bytes(self.chunk_size):
+                        digest.update(chunk)
+                        size += len(chunk)
+                        await asyncio.to_thread(local_file.write, chunk)
+            path = os.path.join(self.directory, digest.hexdigest() + MIME_EXTENSIONS.get(mime_type, ".bin"))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logger.debug("Downloaded {} bytes for file ID {} to {}", size, file_id, path)
+        return path
+
+    def evict(self):
+        """Deletes the least recently used files until the cache fits in `max_bytes`."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        cutoff = time.time() - self.min_age
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if mtime > cutoff:
+                continue
+            os.remove(path)
+            total -= size
+            logger.debug("Evicted {} from the file content cache", path)
+        for file_id, path in list(self._paths.items()):
+            if not os.path.exists(path):
+                del self._paths[file_id]
+
+file_store = FileContentCache(
+    os.environ.get("FILE_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "slackfinal", "files")),
+    max_bytes=int(os.environ.get("FILE_STORE_MAX_BYTES", str(1024 ** 3))),
+)
+
+def file_url(file_id):
+    return f"https://platform.openai.com/files/{file_id}"
+
+def substitute_file_ids(text, known_files):
+    """Replaces every file ID in `text` that appears in `known_files` with its URL in a single pass."""
+    return FILE_ID_PATTERN.sub(
+        lambda match: file_url(match.group(0)) if match.group(0) in known_files else match.group(0),
+        text
+    )
+
+def annotation_file_id(annotation):
+    if annotation.type == "file_citation":
+        return annotation.file_citation.file_id
+    if annotation.type == "file_path":
+        return annotation.file_path.file_id
+    return None
+
+def collect_file_ids(text_contents):
+    """Returns the unique file IDs referenced by the text parts of a message.
+
+    Both annotation targets and bare file IDs in the text are included, so a
+    single `file_cache.get_many` call can resolve everything a message needs.
+    """
+    file_ids = {}
+    for text in text_contents:
+        for annotation in text.annotations:
+            file_id = annotation_file_id(annotation)
+            if file_id:
+                file_ids[file_id] = None
+        for file_id in FILE_ID_PATTERN.findall(text.value):
+            file_ids[file_id] = None
+    return list(file_ids)
+
+def generated_file_ids(message):
+    """Returns the IDs of the files a message hands to the user, in order of appearance.
+
+    Files written by the code interpreter arrive as `file_path` annotations
+    on text parts, and images it draws as `image_file` content parts.
+    """
+    file_ids = {}
+    for content in message.content:
+        if content.type == "text":
+            for annotation in content.text.annotations:
+                if annotation.type == "file_path":
+                    file_ids[annotation.file_path.file_id] = None
+        elif content.type == "image_file":
+            file_ids[content.image_file.file_id] = None
+    return list(file_ids)
+
+def guess_mime_type(file_id, known_files):
+    """Guesses a file's MIME type from the filename in its metadata, or returns None."""
+    file_info = known_files.get(file_id)
+    return mimetypes.guess_type(file_info.filename)[0] if file_info else None
+
+def render_annotation(annotation, known_files):
+    file_info = known_files.get(annotation_file_id(annotation))
+    if annotation.type == "file_citation":
+        return f"[Cited from {file_info.filename}]" if file_info else ""
+    if annotation.type == "file_path":
+        # The file itself is uploaded to the Slack thread with the answer
+        filename = os.path.basename(file_info.filename) if file_info else "file"
+        return f"{filename} (attached)"
+    return annotation.text
+
+def render_annotated_text(text, annotations, known_files):
+    """Rebuilds `text` in one pass, replacing annotations by their offsets and bare file IDs by URLs.
+
+    Args:
+        text (str): The raw text value of a message content part.
+        annotations (list): The annotations of that content part.
+        known_files (dict): File metadata keyed by file ID, as returned by `file_cache.get_many`.
+
+    Returns:
+        str: The rendered text.
+    """
+    pieces = []
+    cursor = 0
+    for annotation in sorted(annotations, key=lambda annotation: annotation.start_index):
+        start, end = annotation.start_index, annotation.end_index
+        if start < cursor or text[start:end] != annotation.text:
+            # Offsets that disagree with the text fall back to locating the marker
+            start = text.find(annotation.text, cursor)
+            if start == -1:
+                logger.warning("Annotation text not found in message: {}", summarize(annotation.text))
+                continue
+            end = start + len(annotation.text)
+        pieces.append(substitute_file_ids(text[cursor:start], known_files))
+        pieces.append(render_annotation(annotation, known_files))
+        cursor = end
+    pieces.append(substitute_file_ids(text[cursor:], known_files))
+    return "".join(pieces)
@@ -0,0 +1,110 @@
+import os
+import random
+import re
+import sys
+from contextlib import contextmanager
+from loguru import logger
+
+# Longest repr of a payload (message, tool call, response) written to the log
+SUMMARY_LIMIT = int(os.environ.get("LOG_SUMMARY_LIMIT", "300"))
+
+# Credentials that may end up in log messages: OpenAI keys, Slack tokens and bearer headers
+SECRET_SYNTAX = r"sk-[A-Za-z0-9_\-]{16,}|xox[abposr]-[A-Za-z0-9\-]+|xapp-[A-Za-z0-9\-]+|Bearer\s+[A-Za-z0-9._\-]+"
+SECRET_ENVIRONMENT_VARIABLES = ("OPENAI_API_KEY", "SLACK_BOT_TOKEN", "SLACK_APP_TOKEN")
+REDACTED = "[REDACTED]"
+
+_secret_pattern = re.compile(SECRET_SYNTAX)
+
+
+def summarize(value, limit=SUMMARY_LIMIT):
+    """Returns a short description of a payload for logging.
+
+    Bytes are reduced to their length, and any other value to its repr cut
+    to `limit` characters. Pass it through `logger.opt(lazy=True)` so the
+    repr is only built when the record is actually written.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return f"<{len(value)} bytes>"
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > limit:
+        return f"{text[:limit]}… ({len(text)} chars)"
+    return text
+
+
+def redact(text):
+    """Replaces credentials in `text` with a placeholder."""
+    return _secret_pattern.sub(REDACTED, text)
+
+
+def _redact_record(record):
+    record["message"] = redact(record["message"])
+
+
+def _compile_secret_pattern():
+    # Besides the well-known token shapes, mask the exact values of the configured secrets
+    values = [os.environ.get(name) for name in SECRET_ENVIRONMENT_VARIABLES]
+    literals = [re.escape(value) for value in sorted(filter(None, values), key=len, reverse=True) if len(value) >= 8]
+    return re.compile("|".join(literals + [SECRET_SYNTAX]))
+
+
+@contextmanager
+def sampled_run(rate=None):
+    """Marks the log records emitted inside the block as part of one sampled or unsampled run.
+
+    In production mode, DEBUG records are only written for runs that were
+    sampled, so a small fraction of requests keeps its full trace while the
+    rest only log INFO and above. The decision is stored in a context
+    variable, so it follows the run into tasks and threads it starts.
+    """
+    if rate is None:
+        rate = float(os.environ.get("LOG_SAMPLE_RATE", "0"))
+    with logger.contextualize(sampled=random.random() < rate):
+        yield
+
+
+def configure_logging(mode=None):
+    """Configures Loguru sinks for the mode selected by the LOG_MODE environment variable.
+
+    "development" keeps the default stderr sink and writes everything at
+    DEBUG to a rotating `app.log`. "production" writes LOG_LEVEL (INFO by
+    default) and above through enqueued sinks, so request handlers never
+    block on disk I/O, and lets DEBUG records through only for runs picked
+    by `sampled_run`. Credentials are redacted in both modes.
+    """
+    global _secret_pattern
+    mode = mode or os.environ.get("LOG_MODE", "development")
+    log_file = os.environ.get("LOG_FILE", "app.log")
+    _secret_pattern = _compile_secret_pattern()
+    logger.configure(patcher=_redact_record)
+
+    if mode == "development":
+        logger.add(log_file, rotation="500 MB", retention="10 days", level="DEBUG")
+    elif mode == "production":
+        level = os.environ.get("LOG_LEVEL", "INFO")
+        level_no = logger.level(level).no
+        sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", "0"))
+
+        def sampled(record):
+            return record["level"].no >= level_no or record["extra"].get("sampled", False)
+
+        # Without sampling the sinks reject DEBUG outright, which lets Loguru
+        # skip debug calls before their arguments are even formatted
+        sink_level = "DEBUG" if sample_rate > 0 else level
+        logger.remove()
+        logger.add(sys.stderr, level=sink_level, filter=sampled, enqueue=True)
+        logger.add(
+            log_file,
+            level=sink_level,
+            filter=sampled,
+            enqueue=True,
+            rotation=os.environ.get("LOG_ROTATION", "100 MB"),
+            retention=os.environ.get("LOG_RETENTION", "10 days")
+        )
+    else:
+        raise ValueError(f"Unknown log mode: {mode}")
+    logger.debug(f"Logging configured in {mode} mode")
+
+
+def flush_logging():
+    """Waits until enqueued log records have been written."""
+    logger.complete()
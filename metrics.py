@@ -0,0 +1,92 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# The drumbeat served by the current run; every stage and run metric is labelled with it
+drumbeat_label = ContextVar("drumbeat_label", default="unknown")
+
+# From quick API calls and Slack posts up to multi-minute runs
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_DURATION = Histogram(
+    "slackbot_stage_duration_seconds",
+    "Time spent in each stage of answering a message",
+    ["stage", "drumbeat"],
+    buckets=LATENCY_BUCKETS
+)
+RUNS = Counter("slackbot_runs_total", "Assistant runs by final status", ["status", "drumbeat"])
+OPENAI_RETRIES = Counter("slackbot_openai_retries_total", "OpenAI requests retried, by endpoint class and error", ["endpoint", "error"])
+RESPONSE_CACHE = Counter("slackbot_response_cache_total", "Response cache lookups by result (hit, shared, miss)", ["result", "drumbeat"])
+QUEUE_DEPTH = Gauge("slackbot_queue_depth", "Jobs admitted to the worker pool and waiting for a worker")
+ACTIVE_WORKERS = Gauge("slackbot_active_workers", "Worker pool jobs currently running")
+
+
+@contextmanager
+def labelled(drumbeat):
+    """Labels the metrics recorded inside the block with `drumbeat`."""
+    token = drumbeat_label.set(drumbeat)
+    try:
+        yield
+    finally:
+        drumbeat_label.reset(token)
+
+
+def observe_stage(name, seconds):
+    STAGE_DURATION.labels(stage=name, drumbeat=drumbeat_label.get()).observe(seconds)
+
+
+@contextmanager
+def stage(name):
+    """Times the block as one span of the stage `name`, whether it succeeds or raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def record_run(status):
+    """Counts a finished run by its final status ("completed", "failed", "error", ...)."""
+    RUNS.labels(status=status or "unknown", drumbeat=drumbeat_label.get()).inc()
+
+
+def record_openai_retry(endpoint, error):
+    OPENAI_RETRIES.labels(endpoint=endpoint, error=error).inc()
+
+
+def record_response_cache(result):
+    RESPONSE_CACHE.labels(result=result, drumbeat=drumbeat_label.get()).inc()
+
+
+class RunTimer:
+    """Measures how long a run spends in each status.
+
+    Call `transition` whenever a status is observed, from stream events or
+    polling; the time since the previous transition is recorded under the
+    previous status as the stage `run_<status>`, e.g. `run_queued` and
+    `run_in_progress`.
+    """
+
+    def __init__(self, status="queued"):
+        self.status = status
+        self.since = time.perf_counter()
+
+    def transition(self, status):
+        if status == self.status:
+            return
+        now = time.perf_counter()
+        observe_stage(f"run_{self.status}", now - self.since)
+        self.status = status
+        self.since = now
+
+
+def track_worker_pool(worker_pool):
+    """Exports the pool's queue depth and active worker count at scrape time."""
+    QUEUE_DEPTH.set_function(lambda: worker_pool.pending)
+    ACTIVE_WORKERS.set_function(lambda: worker_pool.active)
+
+
+def render_metrics():
+    """Returns the Prometheus text exposition of all metrics and its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,205 @@
+import asyncio
+import email.utils
+import heapq
+import itertools
+import os
+import random
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, RateLimitError
+from loguru import logger
+from metrics import observe_stage, record_openai_retry
+
+# Lower numbers are served first when requests queue for the same endpoint class
+USER_PRIORITY = 0
+BACKGROUND_PRIORITY = 10
+
+# Requests per second and burst size per endpoint class; override with
+# OPENAI_RATE_LIMITS, e.g. "runs=5/10,files=20/40"
+DEFAULT_RATE_LIMITS = {
+    "threads": (10.0, 20),
+    "messages": (20.0, 40),
+    "runs": (10.0, 20),
+    "files": (20.0, 40),
+    "default": (10.0, 20),
+}
+
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError, APITimeoutError)
+
+
+def parse_rate_limits(spec):
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        limits[name.strip()] = (float(rate), int(burst or max(float(rate), 1)))
+    return limits
+
+
+def retry_after(error):
+    """Returns the delay in seconds requested by an error response's Retry-After headers, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(retry_at.timestamp() - time.time(), 0.0) if retry_at else None
+
+
+class TokenBucket:
+    """Admits up to `rate` requests per second with bursts of `burst`, serving waiters by priority."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waiters = []
+        self.condition = asyncio.Condition()
+
+    def take(self):
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def block(self, seconds):
+        """Stops admitting requests for `seconds`, e.g. after the API answered 429."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """Schedules OpenAI requests through per-endpoint token buckets and retries transient failures.
+
+    Every request waits for a token from the bucket of its endpoint class,
+    with user-facing requests served before background ones. Rate limit
+    errors, 5xx responses and connection failures are retried with
+    exponential backoff and full jitter, or after the delay the API asks
+    for in Retry-After; a 429 also pauses the whole endpoint class, so
+    concurrent requests queue instead of failing in turn.
+    """
+
+    def __init__(self, rate_limits=None, max_retries=5, base_delay=0.5, max_delay=30.0):
+        self.buckets = {
+            name: TokenBucket(rate, burst) for name, (rate, burst) in (rate_limits or DEFAULT_RATE_LIMITS).items()
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._sequence = itertools.count()
+
+    def bucket(self, endpoint):
+        return self.buckets.get(endpoint) or self.buckets["default"]
+
+    async def acquire(self, endpoint, priority=USER_PRIORITY):
+        """Waits until a request to the endpoint class may be sent."""
+        bucket = self.bucket(endpoint)
+        entry = [priority, next(self._sequence)]
+        start = time.perf_counter()
+        async with bucket.condition:
+            heapq.heappush(bucket.waiters, entry)
+            # A new head of the queue has to compute its own wait
+            bucket.condition.notify_all()
+            try:
+                while True:
+                    if bucket.waiters[0] is not entry:
+                        await bucket.condition.wait()
+                        continue
+                    delay = bucket.take()
+                    if delay <= 0:
+                        heapq.heappop(bucket.waiters)
+                        bucket.condition.notify_all()
+                        break
+                    try:
+                        await asyncio.wait_for(bucket.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in bucket.waiters:
+                    bucket.waiters.remove(entry)
+                    heapq.heapify(bucket.waiters)
+                    bucket.condition.notify_all()
+                raise
+        observe_stage("openai_wait", time.perf_counter() - start)
+
+    def retry_delay(self, endpoint, error, attempt):
+        """Returns how long to wait before retrying after `error`, or None if it should not be retried."""
+        if not isinstance(error, RETRYABLE_ERRORS) or attempt >= self.max_retries:
+            return None
+        requested = retry_after(error)
+        if requested is not None:
+            delay = min(requested, self.max_delay) + random.uniform(0, self.base_delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if isinstance(error, RateLimitError):
+            self.bucket(endpoint).block(delay)
+        record_openai_retry(endpoint, type(error).__name__)
+        logger.warning(f"OpenAI {endpoint} request failed with {type(error).__name__}, retrying in {delay:.2f}s (attempt {attempt + 1})")
+        return delay
+
+    async def call(self, endpoint, method, *args, priority=USER_PRIORITY, **kwargs):
+        """Sends `method(*args, **kwargs)` once admitted, retrying transient failures.
+
+        Args:
+            endpoint (str): The endpoint class whose rate limit applies, e.g. "runs".
+            method (callable): A coroutine method of the shared client.
+            priority (int): USER_PRIORITY or BACKGROUND_PRIORITY.
+        """
+        for attempt in itertools.count():
+            await self.acquire(endpoint, priority)
+            try:
+                return await method(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(endpoint, e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def stream(self, endpoint, open_stream, priority=USER_PRIORITY):
+        """Enters the async context manager returned by `open_stream()` once admitted.
+
+        Failures while opening the stream are retried like `call`; once the
+        stream is open, errors propagate to the caller.
+        """
+        for attempt in itertools.count():
+            await self.acquire(endpoint, priority)
+            stack = AsyncExitStack()
+            try:
+                stream = await stack.enter_async_context(open_stream())
+                break
+            except Exception as e:
+                delay = self.retry_delay(endpoint, e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+        async with stack:
+            yield stream
+
+
+# Retries are handled by the scheduler, so the client itself never retries
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+logger.debug("Initialized OpenAI client")
+
+scheduler = RequestScheduler(
+    rate_limits=parse_rate_limits(os.environ.get("OPENAI_RATE_LIMITS", "")),
+    max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", "5")),
+)
@@ -0,0 +1,323 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from loguru import logger
+
+
+def shard_for(user_id, replica_count):
+    """Maps a user to the index of the replica that handles all of their messages."""
+    digest = hashlib.sha256(user_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % replica_count
+
+
+def open_sqlite(path):
+    """Opens a SQLite database shared between processes, in WAL mode so readers never block the writer."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class DedupStore(ABC):
+    """Remembers the Slack events already accepted, so each one is handled once.
+
+    Slack redelivers events that were not acknowledged in time, possibly to
+    another Socket Mode connection, and every replica holds one. `claim`
+    succeeds for the first delivery of an event ID within `ttl` seconds and
+    fails for every later one, on any replica sharing the store.
+    """
+
+    def __init__(self, ttl=3600.0):
+        self.ttl = ttl
+
+    @abstractmethod
+    def claim(self, event_id):
+        """Returns True if the event was not seen before and is now claimed by the caller."""
+
+    def close(self):
+        pass
+
+
+class MemoryDedupStore(DedupStore):
+    """An in-process dedup store for a single replica, bounded by `max_entries`."""
+
+    def __init__(self, ttl=3600.0, max_entries=100000):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, event_id):
+        now = time.monotonic()
+        with self._lock:
+            while self._seen and next(iter(self._seen.values())) < now:
+                self._seen.popitem(last=False)
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = now + self.ttl
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+            return True
+
+
+class SqliteDedupStore(DedupStore):
+    """A dedup store in a SQLite file shared by all replicas on a host.
+
+    A redelivery is recognized with a plain read, without taking the
+    database's write lock. A first delivery is claimed with a single upsert
+    on the event ID's primary key, so exactly one replica wins each event.
+    Expired IDs are purged every `purge_interval` seconds.
+    """
+
+    def __init__(self, path, ttl=3600.0, purge_interval=300.0):
+        super().__init__(ttl)
+        self.path = path
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._connection = open_sqlite(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS seen_events (event_id TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS seen_events_expires_at ON seen_events (expires_at)")
+        logger.debug(f"SQLite dedup store opened at {path}")
+
+    def claim(self, event_id):
+        now = time.time()
+        with self._lock:
+            self._purge_expired(now)
+            seen = self._connection.execute(
+                "SELECT 1 FROM seen_events WHERE event_id = ? AND expires_at >= ?", (event_id, now)
+            ).fetchone()
+            if seen:
+                return False
+            # Inserts a new ID or takes over an expired one; a live ID is left alone
+            return self._connection.execute(
+                "INSERT INTO seen_events (event_id, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET expires_at = excluded.expires_at WHERE seen_events.expires_at < ?",
+                (event_id, now + self.ttl, now)
+            ).rowcount == 1
+
+    def _purge_expired(self, now):
+        if time.monotonic() - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = time.monotonic()
+        deleted = self._connection.execute("DELETE FROM seen_events WHERE expires_at < ?", (now,)).rowcount
+        if deleted:
+            logger.debug(f"Purged {deleted} expired event IDs")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class JobQueue(ABC):
+    """Hands messages over to the replica that owns their user's shard.
+
+    Slack spreads events over all Socket Mode connections, so a message
+    often arrives at a replica that does not own its user. The receiving
+    replica stores it under the owner's shard with `put`, and each replica
+    takes its own shard's messages in arrival order with `claim`. A claimed
+    message is removed from the queue, so it is processed once. Messages
+    left unclaimed for too long, because their owner is down, are removed
+    by any replica with `expire`, so their users can be told.
+    """
+
+    @abstractmethod
+    def put(self, shard, user_id, item):
+        """Queues a message, a JSON-serializable dict, for the replica owning `shard`."""
+
+    @abstractmethod
+    def claim(self, shard, limit=100):
+        """Removes and returns up to `limit` of the shard's oldest messages as (user_id, item) tuples."""
+
+    @abstractmethod
+    def expire(self, max_age, limit=100):
+        """Removes and returns up to `limit` messages of any shard queued over `max_age` seconds ago."""
+
+    def close(self):
+        pass
+
+
+class SqliteJobQueue(JobQueue):
+    """A job queue in a SQLite file shared by all replicas on a host.
+
+    Polling an empty shard is a plain read; the write lock is only taken
+    when there are messages to claim, and they are deleted in the same
+    transaction that reads them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = open_sqlite(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER NOT NULL, user_id TEXT NOT NULL, "
+            "data TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_shard ON jobs (shard, id)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)")
+        logger.debug(f"SQLite job queue opened at {path}")
+
+    def put(self, shard, user_id, item):
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO jobs (shard, user_id, data, created_at) VALUES (?, ?, ?, ?)",
+                (shard, user_id, json.dumps(item), time.time())
+            )
+
+    def claim(self, shard, limit=100):
+        with self._lock:
+            if not self._connection.execute("SELECT 1 FROM jobs WHERE shard = ? LIMIT 1", (shard,)).fetchone():
+                return []
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT id, user_id, data FROM jobs WHERE shard = ? ORDER BY id LIMIT ?", (shard, limit)
+                ).fetchall()
+                if rows:
+                    self._connection.execute("DELETE FROM jobs WHERE shard = ? AND id <= ?", (shard, rows[-1][0]))
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return [(user_id, json.loads(data)) for _, user_id, data in rows]
+
+    def expire(self, max_age, limit=100):
+        cutoff = time.time() - max_age
+        with self._lock:
+            if not self._connection.execute("SELECT 1 FROM jobs WHERE created_at < ? LIMIT 1", (cutoff,)).fetchone():
+                return []
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._connection.execute(
+                    "SELECT id, user_id, data FROM jobs WHERE created_at < ? ORDER BY id LIMIT ?", (cutoff, limit)
+                ).fetchall()
+                self._connection.executemany("DELETE FROM jobs WHERE id = ?", [(row[0],) for row in rows])
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+        return [(user_id, json.loads(data)) for _, user_id, data in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ReplicaRouter:
+    """Routes each user's messages to one replica, so a user's runs stay ordered.
+
+    With `replica_count` of 1 every message is handled locally. Otherwise
+    every message goes through the shared job queue, even one that arrived
+    at its owner, so messages received by different replicas are still
+    processed in the order they arrived. Messages that waited longer than
+    `max_age` seconds, because their replica is down or far behind, are
+    dropped by whichever replica notices first, instead of being answered
+    whenever their owner comes back.
+    """
+
+    def __init__(self, replica_index=0, replica_count=1, job_queue=None, poll_interval=0.2, max_age=300.0):
+        """
+        Args:
+            replica_index (int): This replica's shard, from 0 to `replica_count` - 1.
+            replica_count (int): The number of replicas sharing the work.
+            job_queue (JobQueue, optional): Carries messages between replicas;
+                required when `replica_count` is above 1.
+            poll_interval (float): Seconds between checks of an empty shard.
+            max_age (float): Seconds a message may wait in the job queue.
+        """
+        if not 0 <= replica_index < replica_count:
+            raise ValueError(f"REPLICA_INDEX must be between 0 and {replica_count - 1}, got {replica_index}")
+        if replica_count > 1 and job_queue is None:
+            raise ValueError("A job queue is required to run more than one replica")
+        self.replica_index = replica_index
+        self.replica_count = replica_count
+        self.job_queue = job_queue
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+
+    @property
+    def replicated(self):
+        return self.replica_count > 1
+
+    def forward(self, user_id, item):
+        """Queues a message for the replica owning the user."""
+        shard = shard_for(user_id, self.replica_count)
+        self.job_queue.put(shard, user_id, item)
+        logger.debug("Forwarded message from {} to replica {}", user_id, shard)
+
+    async def consume(self, on_message, on_expired, stopping=lambda: False):
+        """Feeds queued messages to coroutine functions until cancelled or `stopping()` is true.
+
+        This replica's messages go to `on_message(user_id, item)`; messages
+        of any shard that waited too long go to `on_expired(user_id, item)`.
+        Once `stopping()` is true nothing more is claimed, so the messages
+        still queued are left for the restarted replica or for expiry.
+        """
+        while not stopping():
+            try:
+                expired = await asyncio.to_thread(self.job_queue.expire, self.max_age)
+                jobs = await asyncio.to_thread(self.job_queue.claim, self.replica_index)
+            except Exception as e:
+                logger.error(f"Failed to claim queued messages: {e}")
+                expired, jobs = [], []
+            for user_id, item in expired:
+                logger.warning(f"Dropping a message from {user_id} that waited over {self.max_age:g}s for its replica")
+                try:
+                    await on_expired(user_id, item)
+                except Exception as e:
+                    logger.exception(f"Failed to report an expired message from {user_id}: {e}")
+            for user_id, item in jobs:
+                try:
+                    await on_message(user_id, item)
+                except Exception as e:
+                    logger.exception(f"Failed to handle queued message from {user_id}: {e}")
+            if not jobs:
+                await asyncio.sleep(self.poll_interval)
+
+    def close(self):
+        if self.job_queue is not None:
+            self.job_queue.close()
+
+
+def replica_count():
+    return int(os.environ.get("REPLICA_COUNT", "1"))
+
+
+def replica_db_path():
+    """The SQLite file shared by the replicas; sessions, event IDs and queued messages all live in it."""
+    return os.environ.get("REPLICA_DB_PATH") or os.environ.get("SESSION_DB_PATH", "sessions.db")
+
+
+def create_dedup_store():
+    """Builds the dedup store selected by DEDUP_STORE ("memory" or "sqlite"; sqlite when running several replicas)."""
+    backend = os.environ.get("DEDUP_STORE", "sqlite" if replica_count() > 1 else "memory")
+    ttl = float(os.environ.get("DEDUP_TTL", "3600"))
+    if backend == "sqlite":
+        return SqliteDedupStore(replica_db_path(), ttl=ttl)
+    if backend == "memory":
+        return MemoryDedupStore(ttl=ttl)
+    raise ValueError(f"Unknown dedup store backend: {backend}")
+
+
+def create_replica_router():
+    """Builds the router for this replica from REPLICA_INDEX and REPLICA_COUNT."""
+    count = replica_count()
+    return ReplicaRouter(
+        replica_index=int(os.environ.get("REPLICA_INDEX", "0")),
+        replica_count=count,
+        job_queue=SqliteJobQueue(replica_db_path()) if count > 1 else None,
+        poll_interval=float(os.environ.get("REPLICA_POLL_INTERVAL", "0.2")),
+        max_age=float(os.environ.get("REPLICA_JOB_MAX_AGE", "300")),
+    )
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+from collections import OrderedDict
+from loguru import logger
+from assistants import process_thread_with_assistant
+from metrics import record_response_cache, stage
+from openai_client import client, scheduler
+from tools import tool_registry
+
+# Case, surrounding whitespace, repeated spaces and trailing punctuation do not change a question
+WHITESPACE_PATTERN = re.compile(r"\s+")
+TRAILING_PUNCTUATION = " \t\n?!.;:"
+
+
+def normalize_query(query):
+    return WHITESPACE_PATTERN.sub(" ", query.strip().lower()).rstrip(TRAILING_PUNCTUATION)
+
+
+async def vector_store_fingerprint(vector_store_id, page_size=100):
+    """Returns a hash of the IDs and statuses of all files in a vector store."""
+    entries = []
+    after = {}
+    while True:
+        page = await scheduler.call(
+            "files", client.beta.vector_stores.files.list, vector_store_id, limit=page_size, **after
+        )
+        entries.extend(f"{vector_store_file.id}:{vector_store_file.status}" for vector_store_file in page.data)
+        if len(page.data) < page_size:
+            break
+        after = {"after": page.data[-1].id}
+    return hashlib.sha256("\n".join(sorted(entries)).encode()).hexdigest()
+
+
+class ResponseCache:
+    """Caches answers to stateless questions per assistant, invalidated when its vector store changes.
+
+    Entries are keyed by assistant ID and a hash of the normalized query,
+    plus the asking user whenever tools are registered, since tool results
+    may depend on who asks. They expire after `ttl` seconds, and are
+    evicted least recently used beyond `max_entries`. Each entry remembers
+    the fingerprint of the vector store's file set it was answered from;
+    the fingerprint is re-read at most every `fingerprint_ttl` seconds, and
+    entries answered from an older file set are dropped. Concurrent
+    refreshes of one fingerprint, like identical questions asked while the
+    first one is still running, share a single request.
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600.0, fingerprint_ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.fingerprint_ttl = fingerprint_ttl
+        self._entries = OrderedDict()
+        self._fingerprints = {}
+        self._inflight = {}
+        self._refreshing = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(assistant_id, query, from_user=None):
+        scope = (from_user or "") if tool_registry.tools else ""
+        return hashlib.sha256(f"{assistant_id}\0{scope}\0{normalize_query(query)}".encode()).hexdigest()
+
+    async def seed_thread(self, query, response):
+        """Starts a thread holding the question and its cached answer, so follow-ups have context.
+
+        No run is created, so this costs no tokens. Returns the response with
+        the new thread, or without a thread if it could not be created.
+        """
+        answer = "\n\n".join(response.get("markdown", []))
+        messages = [{"role": "user", "content": query}]
+        if answer:
+            messages.append({"role": "assistant", "content": answer})
+        try:
+            with stage("thread_create"):
+                thread = await scheduler.call("threads", client.beta.threads.create, messages=messages)
+        except Exception as e:
+            logger.warning(f"Could not create a thread for a cached answer: {e}")
+            return dict(response, thread_id=None, message_count=0)
+        return dict(response, thread_id=thread.id, message_count=len(messages))
+
+    async def fingerprint(self, vector_store_id):
+        checked_at, fingerprint = self._fingerprints.get(vector_store_id, (0.0, None))
+        if checked_at + self.fingerprint_ttl > time.monotonic():
+            return fingerprint
+        task = self._refreshing.get(vector_store_id)
+        if task is None:
+            task = asyncio.ensure_future(vector_store_fingerprint(vector_store_id))
+            self._refreshing[vector_store_id] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(vector_store_id, None))
+        current = await asyncio.shield(task)
+        # Concurrent callers share one refresh; only the first to see it records it
+        if self._fingerprints.get(vector_store_id, (0.0, None))[0] > checked_at:
+            return current
+        if fingerprint is not None and current != fingerprint:
+            stale = [key for key, entry in self._entries.items() if entry[1] == vector_store_id]
+            for key in stale:
+                del self._entries[key]
+            logger.info(f"Vector store {vector_store_id} changed, dropped {len(stale)} cached responses")
+        self._fingerprints[vector_store_id] = (time.monotonic(), current)
+        return current
+
+    def _lookup(self, key, fingerprint):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _, entry_fingerprint, response = entry
+        files_present = all(os.path.exists(file["path"]) for file in response.get("files", []))
+        if expires_at < time.monotonic() or entry_fingerprint != fingerprint or not files_present:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _store(self, key, vector_store_id, fingerprint, response):
+        self._entries[key] = (time.monotonic() + self.ttl, vector_store_id, fingerprint, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def answer(self, query, assistant_id, vector_store_id, from_user=None, seed_thread=True, **kwargs):
+        """Answers a new-thread question from the cache, or through `process_thread_with_assistant`.
+
+        Users never share a thread: the user who triggered the run keeps its
+        thread, and with `seed_thread` every cached answer comes with a fresh
+        thread seeded with the question and the answer. Callers that never
+        follow up, like fan-out, pass False to skip that round trip and get
+        cached answers without a thread.
+        """
+        try:
+            fingerprint = await self.fingerprint(vector_store_id)
+        except Exception as e:
+            logger.warning(f"Could not fingerprint vector store {vector_store_id}, bypassing the response cache: {e}")
+            return await process_thread_with_assistant(query, assistant_id, from_user=from_user, **kwargs)
+
+        key = self.key(assistant_id, query, from_user)
+        response = self._lookup(key, fingerprint)
+        if response is not None:
+            record_response_cache("hit")
+            return await self.seed_thread(query, response) if seed_thread else response
+        task = self._inflight.get(key)
+        if task is not None:
+            record_response_cache("shared")
+            response = await asyncio.shield(task)
+            return await self.seed_thread(query, response) if seed_thread else dict(response, thread_id=None, message_count=0)
+
+        record_response_cache("miss")
+        task = asyncio.ensure_future(process_thread_with_assistant(query, assistant_id, from_user=from_user, **kwargs))
+        self._inflight[key] = task
+        # The run goes on when every caller waiting for it gives up, e.g. at a
+        # fan-out deadline, so its answer is stored whenever it arrives
+        task.add_done_callback(lambda _: self._finish(key, vector_store_id, fingerprint, task))
+        return await asyncio.shield(task)
+
+    def _finish(self, key, vector_store_id, fingerprint, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        response = task.result()
+        if response.get("text") or response.get("files"):
+            self._store(key, vector_store_id, fingerprint, dict(response, thread_id=None, message_count=0))
+
+
+async def process_with_cache(
+    response_cache, query, assistant_id, vector_store_id=None, thread_id=None, seed_thread=True, **kwargs
+):
+    """Calls `process_thread_with_assistant`, going through the response cache for new-thread questions.
+
+    Follow-ups in an existing thread depend on the conversation so far and
+    are never cached, nor are questions to assistants without a known
+    vector store, or any question when `response_cache` is None.
+    `seed_thread` is passed on to `ResponseCache.answer`.
+    """
+    if response_cache is None or thread_id is not None or vector_store_id is None:
+        return await process_thread_with_assistant(query, assistant_id, thread_id=thread_id, **kwargs)
+    return await response_cache.answer(query, assistant_id, vector_store_id, seed_thread=seed_thread, **kwargs)
+
+
+def create_response_cache():
+    """Builds the response cache if RESPONSE_CACHE is enabled, otherwise returns None."""
+    if os.environ.get("RESPONSE_CACHE", "false").lower() != "true":
+        return None
+    return ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+        fingerprint_ttl=float(os.environ.get("RESPONSE_CACHE_FINGERPRINT_TTL", "300")),
+    )
@@ -0,0 +1,181 @@
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from loguru import logger
+from replicas import open_sqlite, replica_count, replica_db_path
+
+
+class SessionStore(ABC):
+    """Stores per-user session state such as the OpenAI thread and the selected assistant.
+
+    Sessions are plain dicts. `get` returns a copy filled in with `defaults`,
+    and `update` applies a change atomically, so concurrent workers never
+    lose each other's writes. Sessions idle for longer than `ttl` seconds
+    are treated as missing.
+
+    The methods block, on a database lock for the SQLite store, so async
+    code calls them through `asyncio.to_thread`.
+    """
+
+    def __init__(self, defaults=None, ttl=30 * 24 * 3600.0):
+        self.defaults = defaults or {}
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, user_id):
+        """Returns a copy of the user's session, or the defaults if there is none."""
+
+    @abstractmethod
+    def update(self, user_id, fn=None, **fields):
+        """Atomically updates a user's session and returns the new value.
+
+        Args:
+            user_id (str): The Slack user ID.
+            fn (callable, optional): Called with a copy of the current session;
+                the dict it returns is merged into the session.
+            **fields: Values merged into the session after `fn` is applied.
+        """
+
+    @abstractmethod
+    def delete(self, user_id):
+        """Removes the user's session."""
+
+    def close(self):
+        pass
+
+    def _apply(self, session, fn, fields):
+        session = {**self.defaults, **session}
+        if fn is not None:
+            session.update(fn(dict(session)) or {})
+        session.update(fields)
+        return session
+
+
+class MemorySessionStore(SessionStore):
+    """An in-process session store bounded by `max_entries`, evicting the least recently used session."""
+
+    def __init__(self, defaults=None, ttl=30 * 24 * 3600.0, max_entries=10000):
+        super().__init__(defaults, ttl)
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, user_id):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return {}
+        updated_at, session = entry
+        if updated_at + self.ttl < time.monotonic():
+            del self._sessions[user_id]
+            return {}
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def get(self, user_id):
+        with self._lock:
+            return {**self.defaults, **self._lookup(user_id)}
+
+    def update(self, user_id, fn=None, **fields):
+        with self._lock:
+            session = self._apply(self._lookup(user_id), fn, fields)
+            self._sessions[user_id] = (time.monotonic(), session)
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+            return dict(session)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+
+class SqliteSessionStore(SessionStore):
+    """A session store persisted in SQLite, so sessions survive restarts.
+
+    The database runs in WAL mode so readers never block the writer, and
+    updates run in `BEGIN IMMEDIATE` transactions, which keeps them atomic
+    even when several processes share the file. Expired sessions are purged
+    every `purge_interval` seconds.
+    """
+
+    def __init__(self, path, defaults=None, ttl=30 * 24 * 3600.0, purge_interval=3600.0):
+        super().__init__(defaults, ttl)
+        self.path = path
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._connection = open_sqlite(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        logger.debug(f"SQLite session store opened at {path}")
+
+    def _lookup(self, user_id):
+        row = self._connection.execute(
+            "SELECT data FROM sessions WHERE user_id = ? AND updated_at >= ?",
+            (user_id, time.time() - self.ttl)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get(self, user_id):
+        with self._lock:
+            return {**self.defaults, **self._lookup(user_id)}
+
+    def update(self, user_id, fn=None, **fields):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                session = self._apply(self._lookup(user_id), fn, fields)
+                self._connection.execute(
+                    "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    (user_id, json.dumps(session), time.time())
+                )
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._purge_expired()
+            return dict(session)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        deleted = self._connection.execute(
+            "DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,)
+        ).rowcount
+        if deleted:
+            logger.debug(f"Purged {deleted} expired sessions")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def create_session_store(defaults=None):
+    """Builds the session store selected by the SESSION_STORE environment variable ("memory" or "sqlite").
+
+    Several replicas share their sessions, so they default to SQLite in the
+    replicas' shared database and cannot use the memory store.
+    """
+    replicated = replica_count() > 1
+    backend = os.environ.get("SESSION_STORE", "sqlite" if replicated else "memory")
+    ttl = float(os.environ.get("SESSION_TTL", str(30 * 24 * 3600)))
+    if backend == "sqlite":
+        return SqliteSessionStore(replica_db_path(), defaults=defaults, ttl=ttl)
+    if backend == "memory" and replicated:
+        raise ValueError("SESSION_STORE=memory cannot be shared between replicas; use sqlite")
+    if backend == "memory":
+        max_entries = int(os.environ.get("SESSION_MAX_ENTRIES", "10000"))
+        return MemorySessionStore(defaults=defaults, ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"Unknown session store backend: {backend}")
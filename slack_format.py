@@ -0,0 +1,299 @@
+import re
+
+# Slack truncates long messages; stay comfortably below the 4,000 character guideline
+MAX_MESSAGE_LENGTH = 3900
+# Block Kit limits for a section's text, a header's text and a message's block count
+MAX_SECTION_LENGTH = 3000
+MAX_HEADER_LENGTH = 150
+MAX_BLOCKS_PER_MESSAGE = 50
+
+# Longest span, in characters, that inline syntax may cover. Every opener
+# searches at most this far for its closing delimiter, which keeps a scan
+# linear in the text length even on long lines full of unmatched openers.
+MAX_INLINE_SPAN = 500
+
+# Inline syntax. The text is escaped before it is scanned, so Slack links and
+# quotes are matched in their escaped form. Every alternative starts with a
+# literal character, which lets the regex engine skip plain text in C.
+# Closing delimiters directly follow their lazy span, with the whitespace
+# check after them, so the engine jumps from one candidate closer to the next
+# instead of testing the closer at every character.
+INLINE_SYNTAX = rf"""
+    `(?P<code>[^`\n]{{1,{MAX_INLINE_SPAN}}})`
+  | &lt;(?P<slack_link>(?:https?://|mailto:|[@\#!])[^\s|&]{{0,{MAX_INLINE_SPAN}}}(?:&amp;[^\s|&]{{0,{MAX_INLINE_SPAN}}})*(?:\|(?=[^\n]{{0,{MAX_INLINE_SPAN}}}&gt;)[^\n]{{0,{MAX_INLINE_SPAN}}}?)?)&gt;
+  | \[(?=(?P<link_text>[^\]\n]{{1,{MAX_INLINE_SPAN}}}))(?P=link_text)\]\((?P<link_url>(?=[^)\s])[^()\s]{{0,{MAX_INLINE_SPAN}}}(?:\([^()\s]{{0,{MAX_INLINE_SPAN}}}\)[^()\s]{{0,{MAX_INLINE_SPAN}}})*)\)
+  | \*(?:
+        \*\*(?![\s*])(?P<bold_italic>[^\n]{{1,{MAX_INLINE_SPAN}}}?)\*\*\*(?<!\s\*\*\*)
+      | \*(?![\s*])(?P<bold>[^\n]{{1,{MAX_INLINE_SPAN}}}?)\*\*(?<!\s\*\*)
+      | (?<![\w*]\*)(?![\s*])(?P<italic>[^*\n]{{1,{MAX_INLINE_SPAN}}}?)(?<![\s*])\*(?![\w*])
+    )
+  | _(?:
+        (?<!\w_)_(?![\s_])(?P<bold_underscore>[^\n]{{1,{MAX_INLINE_SPAN}}}?)__(?<!\s__)(?!\w)
+      | (?<![\w_]_)(?![\s_])(?P<italic_underscore>[^_\n]{{1,{MAX_INLINE_SPAN}}}?)(?<![\s_])_(?![\w_])
+    )
+  | ~~(?!\s)(?P<strike>[^\n]{{1,{MAX_INLINE_SPAN}}}?)~~(?<!\s~~)
+"""
+
+# Block-level syntax is matched at the newline that starts its line
+BLOCK_SYNTAX = r"""
+    \n(?P<indent>[ \t]*)(?:
+        (?P<gap>(?=\n))
+      | (?P<fence>(?P<fence_marker>```|~~~)[^\n]*(?P<fence_body>[\s\S]*?)(?:\n[ \t]*(?P=fence_marker)[^\n]*|\Z))
+      | (?P<rule>(?P<rule_marker>[-*_])(?:[ \t]*(?P=rule_marker)){2,}[ \t]*(?=\n|\Z))
+      | (?P<heading>(?P<heading_level>\#{1,6})[ \t]+(?P<heading_text>[^\n]*?)(?:[ \t]+\#+)?[ \t]*(?=\n|\Z))
+      | (?P<quote>&gt;[ \t]?)
+      | (?P<bullet>[-*+][ \t]+)
+      | (?P<ordered>(?P<ordered_number>\d+)[.)][ \t]+)
+    )
+"""
+
+INLINE_PATTERN = re.compile(INLINE_SYNTAX, re.VERBOSE)
+TOKEN_PATTERN = re.compile(BLOCK_SYNTAX + "|" + INLINE_SYNTAX, re.VERBOSE)
+
+# Separates blocks in the rendered output; stripped from the input beforehand
+BLOCK_BREAK = "\x00"
+
+BULLET_SYMBOLS = ("•", "◦", "▪")
+
+
+def escape(text):
+    """Escapes the three characters Slack reserves for control sequences."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def unescape(text):
+    return text.replace("&lt;", "<").replace("&gt;", ">").replace("&amp;", "&")
+
+
+def render_inline_match(match):
+    kind = match.lastgroup
+    if kind == "code":
+        return f"`{match.group('code')}`"
+    if kind == "slack_link":
+        return f"<{match.group('slack_link')}>"
+    if kind == "link_url":
+        return f"<{match.group('link_url')}|{match.group('link_text')}>"
+    if kind == "bold_italic":
+        return f"*_{INLINE_PATTERN.sub(render_inline_match, match.group(kind))}_*"
+    if kind in ("bold", "bold_underscore"):
+        return f"*{INLINE_PATTERN.sub(render_inline_match, match.group(kind))}*"
+    if kind == "strike":
+        return f"~{INLINE_PATTERN.sub(render_inline_match, match.group(kind))}~"
+    return f"_{INLINE_PATTERN.sub(render_inline_match, match.group(kind))}_"
+
+
+def strip_inline_match(match):
+    kind = match.lastgroup
+    if kind == "slack_link":
+        return match.group(0)
+    if kind == "link_url":
+        return match.group("link_text")
+    return INLINE_PATTERN.sub(strip_inline_match, match.group(kind))
+
+
+def parse_blocks(text):
+    """Tokenizes Markdown in a single scan and renders it as Slack mrkdwn blocks.
+
+    Each block is a dict with a `type` (text, heading, code or rule), its
+    rendered `mrkdwn`, and `gap`, which is True when the source had a blank
+    line before it. Headings also carry their `level` and unescaped `plain`
+    text, and code blocks their escaped `code`. Paragraphs, lists and quotes
+    that are not separated by a blank line share one text block.
+    """
+    # Each BLOCK_BREAK in the rendered text starts a new segment; `markers`
+    # holds, per segment, either a finished block or whether a blank line
+    # preceded the text that follows.
+    markers = [False]
+
+    def render(match):
+        kind = match.lastgroup
+        if kind == "gap":
+            markers.append(True)
+            return BLOCK_BREAK
+        if kind == "quote":
+            return "\n>"
+        if kind == "bullet":
+            depth = len(match.group("indent").expandtabs(4)) // 2
+            return f"\n{'    ' * depth}{BULLET_SYMBOLS[min(depth, len(BULLET_SYMBOLS) - 1)]} "
+        if kind == "ordered":
+            depth = len(match.group("indent").expandtabs(4)) // 2
+            return f"\n{'    ' * depth}{match.group('ordered_number')}. "
+        if kind == "fence":
+            code = match.group("fence_body")[1:]
+            block = {"type": "code", "code": code, "mrkdwn": f"```\n{code}\n```"}
+        elif kind == "rule":
+            block = {"type": "rule", "mrkdwn": "───"}
+        elif kind == "heading":
+            title = INLINE_PATTERN.sub(strip_inline_match, match.group("heading_text"))
+            block = {
+                "type": "heading",
+                "level": len(match.group("heading_level")),
+                "plain": unescape(title),
+                "mrkdwn": f"*{title}*"
+            }
+        else:
+            return render_inline_match(match)
+        markers.append(block)
+        markers.append(False)
+        return BLOCK_BREAK + BLOCK_BREAK
+
+    # A leading newline lets the first line match block-level syntax too
+    text = text.replace(BLOCK_BREAK, "").replace("\r\n", "\n")
+    rendered = TOKEN_PATTERN.sub(render, "\n" + escape(text))
+
+    blocks = []
+    gap = False
+    for segment, marker in zip(rendered.split(BLOCK_BREAK), markers):
+        if isinstance(marker, dict):
+            marker["gap"] = gap and bool(blocks)
+            blocks.append(marker)
+            gap = False
+            continue
+        gap = gap or marker
+        segment = segment.strip("\n")
+        if segment.strip():
+            blocks.append({"type": "text", "mrkdwn": segment, "gap": gap and bool(blocks)})
+            gap = False
+    return blocks
+
+
+def join_blocks(blocks):
+    pieces = []
+    for block in blocks:
+        if pieces:
+            pieces.append("\n\n" if block["gap"] else "\n")
+        pieces.append(block["mrkdwn"])
+    return "".join(pieces)
+
+
+def format_for_slack(text):
+    """Formats text for Slack, converting Markdown elements to Slack mrkdwn.
+
+    Args:
+        text (str): The input text with Markdown formatting.
+
+    Returns:
+        str: The formatted text with Slack-compatible formatting.
+    """
+    return join_blocks(parse_blocks(text))
+
+
+def split_lines(text, limit):
+    """Splits text at line boundaries into pieces of at most `limit` characters."""
+    pieces = []
+    current = []
+    size = 0
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                pieces.append("\n".join(current))
+                current, size = [], 0
+            pieces.append(line[:limit])
+            line = line[limit:]
+        if current and size + 1 + len(line) > limit:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        size += len(line) + (1 if current else 0)
+        current.append(line)
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def split_block(block, limit):
+    """Splits a single oversized block into mrkdwn pieces of at most `limit` characters."""
+    if block["type"] == "code":
+        # Every piece of a code block has to be wrapped in its own fence
+        return [f"```\n{piece}\n```" for piece in split_lines(block["code"], limit - 8)]
+    return split_lines(block["mrkdwn"], limit)
+
+
+def split_for_slack(text, limit=MAX_MESSAGE_LENGTH):
+    """Formats Markdown for Slack and splits it into messages of at most `limit` characters.
+
+    Messages are broken between blocks where possible, so lists, quotes and
+    code blocks are only cut when a single block exceeds the limit on its own.
+    """
+    messages = []
+    current = []
+    size = 0
+    for block in parse_blocks(text):
+        separator = ("\n\n" if block["gap"] else "\n") if current else ""
+        if size + len(separator) + len(block["mrkdwn"]) <= limit:
+            current.append(separator + block["mrkdwn"])
+            size += len(separator) + len(block["mrkdwn"])
+            continue
+        if current:
+            messages.append("".join(current))
+            current, size = [], 0
+        if len(block["mrkdwn"]) <= limit:
+            current, size = [block["mrkdwn"]], len(block["mrkdwn"])
+        else:
+            messages.extend(split_block(block, limit))
+    if current:
+        messages.append("".join(current))
+    return messages
+
+
+def section(text):
+    return {"type": "section", "text": {"type": "mrkdwn", "text": text}}
+
+
+def format_for_slack_blocks(text):
+    """Formats Markdown as a list of Block Kit blocks.
+
+    Top-level headings become header blocks, rules become dividers, and
+    consecutive paragraphs, lists, quotes and code blocks are merged into
+    section blocks within Slack's per-section size limit.
+    """
+    result = []
+    pending = []
+    size = 0
+
+    def flush():
+        nonlocal pending, size
+        if pending:
+            result.append(section("".join(pending)))
+            pending, size = [], 0
+
+    for block in parse_blocks(text):
+        if block["type"] == "rule":
+            flush()
+            result.append({"type": "divider"})
+        elif block["type"] == "heading" and block["level"] <= 2:
+            flush()
+            result.append({
+                "type": "header",
+                "text": {"type": "plain_text", "text": block["plain"][:MAX_HEADER_LENGTH] or " ", "emoji": True}
+            })
+        else:
+            separator = ("\n\n" if block["gap"] else "\n") if pending else ""
+            if size + len(separator) + len(block["mrkdwn"]) > MAX_SECTION_LENGTH:
+                flush()
+                separator = ""
+            if len(block["mrkdwn"]) > MAX_SECTION_LENGTH:
+                result.extend(section(piece) for piece in split_block(block, MAX_SECTION_LENGTH))
+                continue
+            pending.append(separator + block["mrkdwn"])
+            size += len(separator) + len(block["mrkdwn"])
+    flush()
+    return result
+
+
+def blocks_fallback_text(blocks, limit=MAX_MESSAGE_LENGTH):
+    """Builds the plain `text` Slack shows in notifications for a list of blocks."""
+    texts = [block["text"]["text"] for block in blocks if "text" in block]
+    return "\n".join(texts)[:limit]
+
+
+def split_blocks_for_slack(text, max_blocks=MAX_BLOCKS_PER_MESSAGE):
+    """Formats Markdown as Block Kit and groups the blocks into Slack messages.
+
+    Returns:
+        list: One dict per message with a fallback `text` and its `blocks`.
+    """
+    blocks = format_for_slack_blocks(text)
+    return [
+        {"text": blocks_fallback_text(chunk), "blocks": chunk}
+        for chunk in (blocks[start:start + max_blocks] for start in range(0, len(blocks), max_blocks))
+    ]
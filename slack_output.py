@@ -0,0 +1,268 @@
+import asyncio
+import itertools
+import re
+import time
+import aiohttp
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from loguru import logger
+from metrics import stage
+from slack_format import MAX_BLOCKS_PER_MESSAGE, MAX_MESSAGE_LENGTH, format_for_slack, section, split_blocks_for_slack
+
+# Retrieval markers such as 【4:0†source】 are only resolved once the answer is complete
+ANNOTATION_MARKER_PATTERN = re.compile(r"【[^】]*】")
+
+
+def merge_texts(texts, limit=MAX_MESSAGE_LENGTH):
+    """Joins consecutive formatted parts into as few messages of at most `limit` characters as possible."""
+    merged = []
+    for text in texts:
+        if merged and len(merged[-1]) + 2 + len(text) <= limit:
+            merged[-1] += "\n\n" + text
+        else:
+            merged.append(text)
+    return merged
+
+
+def slack_messages(response, output_mode="mrkdwn"):
+    """Turns a processed assistant response into chat_postMessage arguments.
+
+    The parts of the answer are merged, then chunked to Slack's size limits,
+    so a multi-part answer takes as few messages as possible.
+
+    Args:
+        response (dict): The result of `process_thread_with_assistant`.
+        output_mode (str): "mrkdwn" for plain formatted text, or "blocks" to
+            render Block Kit headings, lists and code blocks.
+
+    Returns:
+        list: One dict per Slack message with `text` and, in blocks mode, `blocks`.
+    """
+    if output_mode == "blocks":
+        markdown = "\n\n".join(response.get("markdown", []))
+        return split_blocks_for_slack(markdown) if markdown.strip() else []
+    return [{"text": text} for text in merge_texts(response.get("text", []))]
+
+
+def attribute_messages(messages, name):
+    """Labels the first of an answer's messages with the name of the assistant that wrote it."""
+    if not messages:
+        return messages
+    first = dict(messages[0])
+    first["text"] = f"*{name}*\n{first['text']}"
+    if "blocks" in first and len(first["blocks"]) < MAX_BLOCKS_PER_MESSAGE:
+        first["blocks"] = [section(f"*{name}*")] + first["blocks"]
+    return [first] + messages[1:]
+
+
+class ChannelPacer:
+    """Spaces out posts to one channel, releasing them in the order they were requested."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.next_allowed = 0.0
+
+    def block(self, seconds):
+        self.next_allowed = max(self.next_allowed, time.monotonic() + seconds)
+
+    async def wait(self, interval):
+        async with self.lock:
+            delay = self.next_allowed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_allowed = time.monotonic() + interval
+
+
+class SlackPoster:
+    """Sends Slack Web API calls with the async client, so waiting on Slack never blocks the event loop.
+
+    Messages are paced per channel to one every `channel_interval` seconds,
+    Slack's posting limit, and go out in the order they were requested.
+    When Slack answers 429, the channel is paused for the Retry-After delay
+    and the call is retried, up to `max_retries` times. The client and its
+    HTTP session are created on first use, on the loop that uses them.
+    """
+
+    def __init__(self, token, base_url=None, channel_interval=1.0, max_retries=5, max_channels=10000):
+        self.token = token
+        self.base_url = base_url or AsyncWebClient.BASE_URL
+        self.channel_interval = channel_interval
+        self.max_retries = max_retries
+        self.max_channels = max_channels
+        self._session = None
+        self._client = None
+        self._pacers = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._session = aiohttp.ClientSession()
+            self._client = AsyncWebClient(token=self.token, base_url=self.base_url, session=self._session)
+        return self._client
+
+    def _pacer(self, channel):
+        pacer = self._pacers.get(channel)
+        if pacer is None:
+            if len(self._pacers) >= self.max_channels:
+                now = time.monotonic()
+                for idle in [key for key, value in self._pacers.items() if value.next_allowed < now and not value.lock.locked()]:
+                    del self._pacers[idle]
+            pacer = self._pacers[channel] = ChannelPacer()
+        return pacer
+
+    async def call(self, method, paced=False, **kwargs):
+        """Calls a Web API method of the async client, e.g. "chat_postMessage".
+
+        Args:
+            method (str): The client method to call.
+            paced (bool): Whether the call counts against the channel's posting rate.
+            **kwargs: Arguments for the method; `channel` or `channel_id` selects the channel.
+        """
+        channel = kwargs.get("channel") or kwargs.get("channel_id")
+        for attempt in itertools.count():
+            if paced and channel:
+                await self._pacer(channel).wait(self.channel_interval)
+            try:
+                return await getattr(self.client, method)(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                headers = e.response.headers
+                delay = float(headers.get("Retry-After") or headers.get("retry-after") or 1)
+                logger.warning(f"Slack rate limited {method} in channel {channel}, retrying in {delay}s")
+                if paced and channel:
+                    self._pacer(channel).block(delay)
+                else:
+                    await asyncio.sleep(delay)
+
+    async def post_message(self, channel, thread_ts, **message):
+        with stage("slack_post"):
+            return await self.call("chat_postMessage", paced=True, channel=channel, mrkdwn=True, thread_ts=thread_ts, **message)
+
+    async def post_messages(self, channel, thread_ts, messages):
+        """Posts the parts of one answer in order."""
+        for message in messages:
+            await self.post_message(channel, thread_ts, **message)
+
+    async def update_message(self, channel, ts, text, blocks=None):
+        with stage("slack_update"):
+            return await self.call("chat_update", channel=channel, ts=ts, text=text, blocks=blocks)
+
+    async def send_file(self, upload_url, path):
+        """POSTs a local file to a Slack upload URL, streaming it from disk."""
+        with open(path, "rb") as local_file:
+            async with self._session.post(
+                upload_url, data=local_file, headers={"Content-Type": "application/octet-stream"}
+            ) as response:
+                response.raise_for_status()
+                return response.status
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+async def upload_file(poster, file, channel, thread_ts):
+    """Uploads a downloaded file into a Slack thread without loading it into memory.
+
+    This follows the same three steps as `files_upload_v2` (get an upload
+    URL, send the bytes, complete the upload), but streams the file from disk
+    instead of reading it whole.
+
+    Args:
+        poster (SlackPoster): The Slack output client.
+        file (dict): A file as returned by `file_store.download`.
+        channel (str): The channel to share the file in.
+        thread_ts (str): The thread to share the file in.
+    """
+    with stage("slack_upload"):
+        upload = await poster.call("files_getUploadURLExternal", filename=file["filename"], length=file["size"])
+        status = await poster.send_file(upload["upload_url"], file["path"])
+        logger.debug("Uploaded {} bytes of {} with status {}", file["size"], file["filename"], status)
+        await poster.call(
+            "files_completeUploadExternal",
+            files=[{"id": upload["file_id"], "title": file["filename"]}],
+            channel_id=channel,
+            thread_ts=thread_ts
+        )
+
+
+async def upload_files(poster, files, channel, thread_ts):
+    for file in files:
+        try:
+            await upload_file(poster, file, channel, thread_ts)
+        except Exception as e:
+            logger.error(f"Failed to upload {file['filename']} to channel {channel}: {e}")
+
+
+class ProgressiveMessage:
+    """A Slack message that is posted once and then edited in place as an answer streams in.
+
+    Edits are throttled to at most one per `min_interval` seconds; intermediate
+    texts are coalesced so only the latest one is sent.
+    """
+
+    def __init__(self, poster, channel, thread_ts, placeholder="_Thinking…_", min_interval=1.0):
+        self.poster = poster
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self.placeholder = placeholder
+        self.min_interval = min_interval
+        self.ts = None
+        self._latest_text = None
+        self._sent_text = None
+        self._last_update = 0.0
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """Posts the placeholder message."""
+        response = await self.poster.post_message(self.channel, self.thread_ts, text=self.placeholder)
+        self.ts = response["ts"]
+        self._last_update = time.monotonic()
+        logger.debug("Posted placeholder message {} in channel {}", self.ts, self.channel)
+
+    async def update(self, raw_text):
+        """Schedules an edit showing the partial answer `raw_text`."""
+        self._latest_text = raw_text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        delay = self._last_update + self.min_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        preview = format_for_slack(ANNOTATION_MARKER_PATTERN.sub("", self._latest_text))
+        if len(preview) > MAX_MESSAGE_LENGTH:
+            preview = preview[:MAX_MESSAGE_LENGTH] + "…"
+        await self._edit(preview)
+
+    async def _edit(self, text, blocks=None):
+        async with self._lock:
+            if text == self._sent_text and blocks is None:
+                return
+            try:
+                await self.poster.update_message(self.channel, self.ts, text, blocks)
+                self._sent_text = text
+            except Exception as e:
+                logger.warning(f"Failed to update message {self.ts} in channel {self.channel}: {e}")
+            self._last_update = time.monotonic()
+
+    async def finish(self, messages, has_files=False):
+        """Replaces the preview with the final answer.
+
+        Args:
+            messages (list): Message dicts as returned by `slack_messages`. The
+                first one overwrites the placeholder; the rest are posted as
+                new messages in the same thread.
+            has_files (bool): Whether files are uploaded with the answer, so an
+                answer without text is not reported as a failure.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        if not messages and has_files:
+            messages = [{"text": "Here are the files from my answer:"}]
+        elif not messages:
+            messages = [{"text": "Sorry, I couldn't process your request."}]
+        await self._edit(messages[0]["text"], messages[0].get("blocks"))
+        await self.poster.post_messages(self.channel, self.thread_ts, messages[1:])
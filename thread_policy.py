@@ -0,0 +1,103 @@
+import os
+import time
+from openai import NOT_GIVEN
+from loguru import logger
+from logging_config import summarize
+from metrics import stage
+from openai_client import client, scheduler
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below between a user and an assistant in at most {words} words. "
+    "Keep the facts, decisions, names, numbers and open questions the assistant would need to continue "
+    "the conversation, and leave out pleasantries."
+)
+SUMMARY_PREFIX = "Summary of our earlier conversation, for context:\n\n"
+
+
+class ThreadPolicy:
+    """Decides how much of a user's thread a run reads and when the thread is replaced.
+
+    Runs read only the last `truncate_messages` messages of the thread when
+    it is set, instead of letting the thread's history grow into every run.
+    A thread is rotated once it holds `max_messages` messages or has been
+    idle for `idle_timeout` seconds: the last `summary_messages` messages
+    are condensed into a short summary, and a fresh thread is started with
+    that summary as its first message. A limit of 0 disables it.
+    """
+
+    def __init__(self, truncate_messages=0, max_messages=50, idle_timeout=24 * 3600.0,
+                 summary_model="gpt-4o", summary_messages=20, summary_words=200):
+        self.truncate_messages = truncate_messages
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.summary_model = summary_model
+        self.summary_messages = summary_messages
+        self.summary_words = summary_words
+
+    def truncation_strategy(self):
+        """Returns the `truncation_strategy` argument for new runs."""
+        if not self.truncate_messages:
+            return NOT_GIVEN
+        return {"type": "last_messages", "last_messages": self.truncate_messages}
+
+    def rotation_reason(self, message_count, last_active):
+        """Returns why a thread with these stats should be rotated, or None to keep it."""
+        if self.max_messages and message_count >= self.max_messages:
+            return f"{message_count} messages"
+        if self.idle_timeout and last_active and time.time() - last_active >= self.idle_timeout:
+            return f"idle for {time.time() - last_active:.0f}s"
+        return None
+
+    async def summarize_thread(self, thread_id):
+        """Condenses the latest messages of a thread into a short summary, or returns None."""
+        messages = await scheduler.call(
+            "messages",
+            client.beta.threads.messages.list,
+            thread_id=thread_id,
+            order="desc",
+            limit=self.summary_messages
+        )
+        transcript = []
+        for message in reversed(messages.data):
+            text = "\n".join(content.text.value for content in message.content if content.type == "text")
+            if text:
+                transcript.append(f"{message.role}: {text}")
+        if not transcript:
+            return None
+        completion = await scheduler.call(
+            "chat",
+            client.chat.completions.create,
+            model=self.summary_model,
+            messages=[
+                {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=self.summary_words)},
+                {"role": "user", "content": "\n\n".join(transcript)}
+            ]
+        )
+        return completion.choices[0].message.content
+
+    async def rotate(self, thread_id):
+        """Starts a fresh thread seeded with a summary of `thread_id`.
+
+        Returns:
+            tuple: The new thread ID and the number of messages it starts with.
+        """
+        try:
+            with stage("thread_summary"):
+                summary = await self.summarize_thread(thread_id)
+        except Exception as e:
+            logger.warning(f"Could not summarize thread {thread_id}, starting the new thread without a summary: {e}")
+            summary = None
+        logger.opt(lazy=True).debug("Summary of thread {}: {}", lambda: thread_id, lambda: summarize(summary))
+        seed = [{"role": "user", "content": SUMMARY_PREFIX + summary}] if summary else NOT_GIVEN
+        with stage("thread_create"):
+            thread = await scheduler.call("threads", client.beta.threads.create, messages=seed)
+        return thread.id, 1 if summary else 0
+
+
+thread_policy = ThreadPolicy(
+    truncate_messages=int(os.environ.get("THREAD_TRUNCATE_MESSAGES", "0")),
+    max_messages=int(os.environ.get("THREAD_MAX_MESSAGES", "50")),
+    idle_timeout=float(os.environ.get("THREAD_IDLE_TIMEOUT", str(24 * 3600))),
+    summary_model=os.environ.get("THREAD_SUMMARY_MODEL", "gpt-4o"),
+    summary_messages=int(os.environ.get("THREAD_SUMMARY_MESSAGES", "20")),
+)
@@ -0,0 +1,164 @@
+import asyncio
+import functools
+import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from loguru import logger
+from metrics import stage
+
+# How a tool's handler is run: awaited on the event loop, in the thread pool
+# (blocking I/O), or in the process pool (CPU-heavy work; the handler and its
+# arguments must be picklable)
+TOOL_MODES = ("async", "thread", "process")
+
+
+class Tool:
+    """A registered function the assistants can call, with its execution limits.
+
+    Handlers are called as `handler(arguments, from_user)` and return a
+    JSON-serializable result. Results of tools with a `cache_ttl` are cached
+    by their arguments for that many seconds, so only idempotent tools
+    should set it.
+    """
+
+    def __init__(self, name, handler, mode="async", timeout=60.0, cache_ttl=0.0, max_concurrency=4, cache_max_entries=1024):
+        if mode not in TOOL_MODES:
+            raise ValueError(f"Unknown tool mode: {mode}")
+        self.name = name
+        self.handler = handler
+        self.mode = mode
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._cache = OrderedDict()
+
+    def cached(self, key):
+        """Returns (hit, result) for a cached call."""
+        entry = self._cache.get(key)
+        if entry is None:
+            return False, None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return False, None
+        self._cache.move_to_end(key)
+        return True, result
+
+    def store(self, key, result):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, result)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_max_entries:
+            self._cache.popitem(last=False)
+
+
+class ToolRegistry:
+    """Maps function names to tools and runs tool calls within their limits.
+
+    Every call is bounded by its tool's timeout, which covers waiting for a
+    concurrency slot as well as running, so a slow tool yields an error
+    output in time for the run to continue instead of expiring in
+    `requires_action`. Thread and process handlers cannot be interrupted;
+    a timed-out call keeps its concurrency slot until it actually returns,
+    so a stuck tool cannot pile up workers.
+    """
+
+    def __init__(self, default_timeout=60.0, thread_workers=8, process_workers=None):
+        self.default_timeout = default_timeout
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.tools = {}
+        self._thread_pool = None
+        self._process_pool = None
+
+    def register(self, name=None, mode="async", timeout=None, cache_ttl=0.0, max_concurrency=4):
+        """Decorator registering a handler as a tool.
+
+        Example:
+            @tool_registry.register("get_project_status", mode="thread", timeout=20, cache_ttl=300)
+            def get_project_status(arguments, from_user):
+                ...
+        """
+        def decorator(handler):
+            tool_name = name or handler.__name__
+            self.tools[tool_name] = Tool(
+                tool_name,
+                handler,
+                mode=mode,
+                timeout=timeout or self.default_timeout,
+                cache_ttl=cache_ttl,
+                max_concurrency=max_concurrency
+            )
+            logger.debug(f"Registered {mode} tool {tool_name}")
+            return handler
+        return decorator
+
+    def _executor(self, mode):
+        if mode == "thread":
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(self.thread_workers, thread_name_prefix="tool")
+            return self._thread_pool
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(self.process_workers)
+        return self._process_pool
+
+    async def _run(self, tool, arguments, from_user):
+        await tool.semaphore.acquire()
+        if tool.mode == "async":
+            try:
+                return await tool.handler(arguments, from_user)
+            finally:
+                tool.semaphore.release()
+
+        def finished(future):
+            tool.semaphore.release()
+            if not future.cancelled():
+                future.exception()
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self._executor(tool.mode), functools.partial(tool.handler, arguments, from_user)
+        )
+        future.add_done_callback(finished)
+        return await asyncio.shield(future)
+
+    async def execute(self, name, arguments, from_user):
+        """Runs a tool call and returns its output, or an error output if it failed or timed out."""
+        tool = self.tools.get(name)
+        if tool is None:
+            return {"status": "error", "message": "Function not recognized"}
+
+        cache_key = json.dumps(arguments, sort_keys=True, default=str) if tool.cache_ttl else None
+        if cache_key is not None:
+            hit, result = tool.cached(cache_key)
+            if hit:
+                logger.debug("Tool {} served from the result cache", name)
+                return result
+
+        try:
+            with stage(f"tool_{name}"):
+                result = await asyncio.wait_for(self._run(tool, arguments, from_user), tool.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool {name} timed out after {tool.timeout}s")
+            return {"status": "error", "message": f"The {name} tool timed out after {tool.timeout:g} seconds"}
+        except Exception as e:
+            logger.exception(f"Tool {name} failed: {e}")
+            return {"status": "error", "message": f"The {name} tool failed: {e}"}
+
+        if cache_key is not None:
+            tool.store(cache_key, result)
+        return result
+
+    async def close(self):
+        """Shuts the executors down without waiting for calls that are still running."""
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+
+tool_registry = ToolRegistry(
+    default_timeout=float(os.environ.get("TOOL_TIMEOUT", "60")),
+    thread_workers=int(os.environ.get("TOOL_THREAD_WORKERS", "8")),
+    process_workers=int(os.environ["TOOL_PROCESS_WORKERS"]) if os.environ.get("TOOL_PROCESS_WORKERS") else None,
+)
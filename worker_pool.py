@@ -0,0 +1,173 @@
+import asyncio
+import concurrent.futures
+import threading
+from loguru import logger
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the admission queue is at its limit."""
+
+
+class WorkerPool:
+    """A bounded pool of async workers running on one long-lived event loop.
+
+    The loop lives in a dedicated background thread so synchronous Bolt
+    handlers can hand work over with `submit` and return immediately. Jobs
+    are zero-argument callables returning a coroutine; they are started in
+    FIFO order by at most `concurrency` workers, and at most `queue_limit`
+    jobs may wait for a free worker.
+    """
+
+    def __init__(self, concurrency=8, queue_limit=100, drain_timeout=30.0):
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.drain_timeout = drain_timeout
+        self.loop = None
+        self._thread = None
+        self._queue = None
+        self._workers = []
+        self._background = []
+        self._graceful = []
+        self._cleanups = []
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._active = 0
+        self._accepting = False
+        self._stopping = False
+
+    @property
+    def stopping(self):
+        """True once shutdown has begun; graceful background coroutines should return."""
+        return self._stopping
+
+    @property
+    def pending(self):
+        """Number of jobs admitted but not yet picked up by a worker."""
+        return self._pending
+
+    @property
+    def active(self):
+        """Number of jobs currently being executed."""
+        return self._active
+
+    def start(self):
+        """Starts the event loop thread and the worker tasks."""
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            self._queue = asyncio.Queue()
+            self._workers = [
+                self.loop.create_task(self._worker(index)) for index in range(self.concurrency)
+            ]
+            ready.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run_loop, name="worker-pool", daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._accepting = True
+        logger.debug(f"Worker pool started with concurrency={self.concurrency}, queue_limit={self.queue_limit}")
+
+    def submit(self, job):
+        """Admits a job for execution.
+
+        Args:
+            job (callable): A zero-argument callable returning a coroutine.
+
+        Returns:
+            int: 0 if the job starts right away, otherwise its 1-based position
+                among the jobs waiting for a free worker.
+
+        Raises:
+            QueueFullError: If the pool is not accepting work or the queue is full.
+        """
+        with self._lock:
+            if not self._accepting:
+                raise QueueFullError("Worker pool is not accepting new jobs")
+            waiting = max(self._active + self._pending - self.concurrency, 0)
+            if waiting >= self.queue_limit:
+                raise QueueFullError(f"Worker pool queue is full ({waiting} jobs waiting)")
+            self._pending += 1
+            position = max(self._active + self._pending - self.concurrency, 0)
+        self.loop.call_soon_threadsafe(self._queue.put_nowait, job)
+        logger.debug("Job admitted to worker pool at position {}", position)
+        return position
+
+    def run_coroutine(self, coro):
+        """Schedules a coroutine on the pool's loop outside the admission queue.
+
+        Returns:
+            concurrent.futures.Future: The future of the scheduled coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def spawn(self, coro, graceful=False):
+        """Runs a long-lived background coroutine on the pool's loop until shutdown.
+
+        Background coroutines are cancelled at shutdown, except `graceful`
+        ones: they must return on their own once `stopping` is set, and are
+        awaited before the pool stops admitting jobs, so work they already
+        picked up can still be submitted.
+        """
+        future = self.run_coroutine(coro)
+        (self._graceful if graceful else self._background).append(future)
+        return future
+
+    def add_cleanup(self, cleanup):
+        """Registers a coroutine function to await on the pool's loop once all jobs are done at shutdown."""
+        self._cleanups.append(cleanup)
+
+    async def _worker(self, index):
+        while True:
+            job = await self._queue.get()
+            with self._lock:
+                self._pending -= 1
+                self._active += 1
+            try:
+                await job()
+            except Exception as e:
+                logger.exception(f"Worker {index} failed while running a job: {e}")
+            finally:
+                with self._lock:
+                    self._active -= 1
+                self._queue.task_done()
+
+    async def _drain(self):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.drain_timeout)
+            logger.debug("Worker pool drained")
+        except asyncio.TimeoutError:
+            logger.warning(f"Worker pool drain timed out after {self.drain_timeout}s with {self._pending} pending and {self._active} active jobs")
+        for future in self._background:
+            future.cancel()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for cleanup in self._cleanups:
+            try:
+                await cleanup()
+            except Exception as e:
+                logger.exception(f"Worker pool cleanup failed: {e}")
+
+    def shutdown(self):
+        """Stops graceful background coroutines and admitting jobs, waits for queued and running jobs, then stops the loop."""
+        with self._lock:
+            if self._stopping or not self._accepting:
+                return
+            self._stopping = True
+        _, unfinished = concurrent.futures.wait(self._graceful, timeout=self.drain_timeout)
+        for future in unfinished:
+            logger.warning("A graceful background task did not stop in time, cancelling it")
+            future.cancel()
+        with self._lock:
+            self._accepting = False
+        logger.info(f"Draining worker pool: {self._pending} pending, {self._active} active jobs")
+        asyncio.run_coroutine_threadsafe(self._drain(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+        logger.info("Worker pool stopped")